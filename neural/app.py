@@ -11,13 +11,9 @@ def gradio_infer(npc_id, npc_location, player_utt):
 
 # ping: Check status and wake up
 def ping():
-    # Check if model is loaded, load if not
-    global wrapper, tokenizer, model, flags_order
-    if 'model' not in globals() or model is None:
-        from model_loader import ModelWrapper
-        wrapper = ModelWrapper()
-        tokenizer, model, flags_order = wrapper.get()
-    return {"status": "awake"}
+    # the model is loaded once per process, when inference is imported (above)
+    import inference
+    return {"status": "awake", "branch": inference.wrapper.branch}
 
 
 if __name__ == "__main__":
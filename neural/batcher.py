@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS
+
+
+class RequestCoalescer:
+    """
+    Async front for run_inference_batch().
+    Gathers concurrent submit() calls for up to `max_wait_ms` (or until `max_batch_size`
+    requests are queued), runs them as one batch on a single model thread, and hands
+    every caller its own result dict. Requests for different adapters can share a batch;
+    run_inference_batch() splits it per adapter. Requests with different gen_params run
+    as separate batches.
+    """
+
+    def __init__(self, max_batch_size: int = BATCH_MAX_SIZE, max_wait_ms: float = BATCH_MAX_WAIT_MS,
+                 infer_fn=None):
+        if infer_fn is None:
+            from inference import run_inference_batch as infer_fn  # loads the model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._infer_fn = infer_fn
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="neural-batch")
+        self._queue = None
+        self._worker = None
+        self.stats = {"requests": 0, "batches": 0, "max_batch": 0}
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, prompt: str, adapter: str = None, gen_params: dict = None) -> dict:
+        self._ensure_worker()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, adapter, gen_params or {}, fut))
+        return await fut
+
+    def depth(self) -> int:
+        """Requests waiting for the next batch."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            groups = {}
+            for item in batch:
+                if not item[3].cancelled():  # caller gone
+                    groups.setdefault(tuple(sorted(item[2].items())), []).append(item)
+            for group in groups.values():
+                await self._run_group(loop, group)
+
+    async def _run_group(self, loop, group):
+        prompts = [p for p, _, _, _ in group]
+        adapters = [a for _, a, _, _ in group]
+        params = group[0][2]
+        self.stats["requests"] += len(group)
+        self.stats["batches"] += 1
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(group))
+        kwargs = {"adapters": adapters, "gen_params": params} if params else {"adapters": adapters}
+        try:
+            results = await loop.run_in_executor(
+                self._executor, functools.partial(self._infer_fn, prompts, **kwargs)
+            )
+        except Exception as e:
+            for _, _, _, fut in group:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, _, _, fut), result in zip(group, results):
+            if not fut.done():
+                fut.set_result(result)
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,326 @@
+"""
+Neural engine benchmarks / checks (requires the model to be loadable).
+
+    python benchmark.py parity      # single-pass heads == two-pass heads (greedy)
+    python benchmark.py batch       # run_inference_batch / RequestCoalescer throughput
+    python benchmark.py prefix      # prefill latency with/without the header KV-cache
+    python benchmark.py state       # predict_state latency vs full run_inference
+    python benchmark.py choices     # score_choices vs per-choice inference
+    python benchmark.py stopping    # tokens/latency saved by dialogue-aware stopping
+    python benchmark.py speculative # assisted decoding speedup / acceptance (needs DRAFT_MODEL)
+    python benchmark.py adapters    # adapter switch cost / memory per adapter (needs LORA_ADAPTERS)
+    python benchmark.py static      # per-token decode latency, dynamic vs compiled static cache (needs STATIC_DECODE)
+"""
+import argparse
+import asyncio
+import time
+
+import inference
+import torch
+from batcher import RequestCoalescer
+from modules.case_loader import load_cases
+from webtest_prompt import _assemble_prompt_for_model
+
+GREEDY = {"do_sample": False, "temperature": None, "top_p": None}
+
+
+def case_prompts():
+    return [_assemble_prompt_for_model(c["input"]) for c in load_cases()]
+
+
+def _heads(pooled):
+    m = inference.model
+    return (
+        torch.tanh(m.delta_head(pooled)),
+        torch.sigmoid(m.flag_head(pooled)),
+        torch.sigmoid(m.flag_threshold_head(pooled)),
+    )
+
+
+def bench_parity(args):
+    """Compare single-pass and two-pass head outputs bit-for-bit with greedy decoding."""
+    params = {**inference.GEN_PARAMS, **GREEDY, "max_new_tokens": args.max_new_tokens}
+    ok = True
+    for i, prompt in enumerate(case_prompts()):
+        inputs, _ = inference._encode([prompt])
+        with torch.no_grad():
+            t0 = time.perf_counter()
+            ids_two, pooled_two = inference._generate_with_state(inputs, params, single_pass=False)
+            t1 = time.perf_counter()
+            ids_one, pooled_one = inference._generate_with_state(inputs, params, single_pass=True)
+            t2 = time.perf_counter()
+            same = torch.equal(ids_one, ids_two) and all(
+                torch.equal(a, b) for a, b in zip(_heads(pooled_one), _heads(pooled_two))
+            )
+        ok &= same
+        print(f"case {i+1}: {'MATCH' if same else 'MISMATCH'}  two-pass={t1-t0:.2f}s  single-pass={t2-t1:.2f}s")
+    print("PASS" if ok else "FAIL")
+    return 0 if ok else 1
+
+
+def _prompts(n):
+    prompts = case_prompts()
+    return [prompts[i % len(prompts)] for i in range(n)]
+
+
+def bench_batch(args):
+    """Turns/sec of run_inference_batch per batch size, then through the async coalescer."""
+    params = {**GREEDY, "max_new_tokens": args.max_new_tokens}
+    sizes = [int(x) for x in args.sizes.split(",")]
+    inference.run_inference_batch(_prompts(1), gen_params=params)  # warm-up
+
+    base = None
+    for bs in sizes:
+        prompts = _prompts(bs)
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            inference.run_inference_batch(prompts, gen_params=params)
+        dt = time.perf_counter() - t0
+        tps = bs * args.repeat / dt
+        base = base or tps
+        print(f"batch={bs:3d}  {tps:7.3f} turns/s  x{tps / base:.2f}")
+
+    async def _concurrent(n):
+        coalescer = RequestCoalescer(
+            max_batch_size=max(sizes),
+            infer_fn=lambda ps, adapters=None: inference.run_inference_batch(ps, gen_params=params, adapters=adapters),
+        )
+        t0 = time.perf_counter()
+        await asyncio.gather(*(coalescer.submit(p) for p in _prompts(n)))
+        dt = time.perf_counter() - t0
+        await coalescer.close()
+        return dt, coalescer.stats
+
+    n = max(sizes) * args.repeat
+    dt, stats = asyncio.run(_concurrent(n))
+    print(f"coalescer: {n} concurrent turns  {n / dt:7.3f} turns/s  "
+          f"batches={stats['batches']} max_batch={stats['max_batch']}")
+    return 0
+
+
+def bench_prefix(args):
+    """Prefill latency (max_new_tokens=1) of follow-up turns with the prefix cache off vs on."""
+    params = {**GREEDY, "max_new_tokens": 1}
+    cases = [c["input"] for c in load_cases()]
+    turns = [
+        _assemble_prompt_for_model({**c, "player_utterance": f"{c['player_utterance']} ({t})"})
+        for c in cases for t in range(args.turns)
+    ]
+    cache = inference.prefix_cache
+    max_bytes = cache.max_bytes
+
+    def _run():
+        t0 = time.perf_counter()
+        for prompt in turns:
+            inference.run_inference(prompt, gen_params=params)
+        return (time.perf_counter() - t0) / len(turns)
+
+    cache.max_bytes = 0
+    off = _run()
+    cache.max_bytes = max_bytes or 1024 * 1024 * 1024
+    cache.clear()
+    on = _run()
+    cache.max_bytes = max_bytes
+    print(f"prefill/turn  no-cache={off * 1000:.1f}ms  prefix-cache={on * 1000:.1f}ms  x{off / on:.2f}")
+    print(inference.cache_stats())
+    return 0
+
+
+def bench_state(args):
+    """Latency of heads-only predict_state / predict_state_batch vs full run_inference."""
+    prompts = case_prompts()
+    inference.predict_state(prompts[0])  # warm-up
+
+    def _timed(fn):
+        t0 = time.perf_counter()
+        fn()
+        return (time.perf_counter() - t0) / len(prompts)
+
+    full = _timed(lambda: [inference.run_inference(p) for p in prompts])
+    state = _timed(lambda: [inference.predict_state(p) for p in prompts])
+    batch = _timed(lambda: inference.predict_state_batch(prompts))
+    print(f"per prompt  run_inference={full:.2f}s  predict_state={state:.3f}s (x{full / state:.1f})  "
+          f"predict_state_batch={batch:.3f}s (x{full / batch:.1f})")
+    return 0
+
+
+def bench_choices(args):
+    """Score N candidate utterances with score_choices vs N predict_state / run_inference calls."""
+    pre = load_cases()[0]["input"]
+    candidates = [f"{pre['player_utterance']} ({i + 1})" for i in range(args.n)]
+    prompts = [_assemble_prompt_for_model({**pre, "player_utterance": c}) for c in candidates]
+    inference.score_choices(pre, candidates[:1])  # warm-up
+
+    def _timed(fn):
+        t0 = time.perf_counter()
+        fn()
+        return time.perf_counter() - t0
+
+    batched = _timed(lambda: inference.score_choices(pre, candidates))
+    states = _timed(lambda: [inference.predict_state(p) for p in prompts])
+    print(f"{args.n} choices  score_choices={batched:.3f}s  {args.n}x predict_state={states:.3f}s")
+    if args.full:
+        full = _timed(lambda: [inference.run_inference(p) for p in prompts])
+        print(f"{args.n}x run_inference={full:.2f}s (x{full / batched:.1f})")
+    return 0
+
+
+def bench_stopping(args):
+    """Generated tokens and latency per test case with and without DialogueStopper."""
+    from collections import Counter
+
+    params = {"max_new_tokens": args.max_new_tokens}
+    if not args.sample:
+        params = {**params, **GREEDY}
+
+    def _run(stopping):
+        tokens, reasons = 0, Counter()
+        t0 = time.perf_counter()
+        for prompt in case_prompts():
+            result = inference.run_inference(prompt, gen_params=params, stopping=stopping)
+            tokens += len(inference.tokenizer(result["npc_output_text"])["input_ids"])
+            reasons[result.get("stop_reason", "n/a")] += 1
+        return tokens, time.perf_counter() - t0, reasons
+
+    base_tokens, base_time, _ = _run(False)
+    stop_tokens, stop_time, reasons = _run(True)
+    print(f"no stopping : {base_tokens:5d} tokens  {base_time:.2f}s")
+    print(f"stopping    : {stop_tokens:5d} tokens  {stop_time:.2f}s  "
+          f"saved {base_tokens - stop_tokens} tokens / {base_time - stop_time:.2f}s")
+    print(f"stop reasons: {dict(reasons)}")
+    return 0
+
+
+def bench_speculative(args):
+    """Decode latency with and without the draft model, plus acceptance rate (greedy)."""
+    if inference.draft_model is None:
+        print("DRAFT_MODEL is not set")
+        return 1
+    params = {**GREEDY, "max_new_tokens": args.max_new_tokens}
+    prompts = case_prompts()
+
+    def _run(extra):
+        tokens = 0
+        t0 = time.perf_counter()
+        for prompt in prompts:
+            result = inference.run_inference(prompt, gen_params={**params, **extra}, stopping=False)
+            tokens += len(inference.tokenizer(result["npc_output_text"])["input_ids"])
+        return tokens, time.perf_counter() - t0
+
+    base_tokens, base_time = _run({"assistant_model": None})
+    spec_tokens, spec_time = _run({})
+    print(f"baseline    : {base_tokens / base_time:6.2f} tok/s  {base_time:.2f}s")
+    print(f"speculative : {spec_tokens / spec_time:6.2f} tok/s  {spec_time:.2f}s  x{base_time / spec_time:.2f}")
+    print(inference.speculative_stats())
+    return 0
+
+
+def bench_static(args):
+    """Per-token decode latency (greedy, fixed length) with the dynamic cache vs the compiled static path."""
+    if not getattr(inference.wrapper, "static_decode", False):
+        print("STATIC_DECODE is not enabled (or compilation fell back)")
+        return 1
+    n = args.max_new_tokens
+    prompts = case_prompts()
+
+    def _timed(prompt, tokens):
+        params = {**GREEDY, "max_new_tokens": tokens, "min_new_tokens": tokens}
+        t0 = time.perf_counter()
+        inference.run_inference(prompt, gen_params=params, stopping=False)
+        return time.perf_counter() - t0
+
+    def _per_token_ms(static):
+        inference.static_decode = static
+        _timed(prompts[0], n)  # warm-up
+        per_token = [(_timed(p, n) - _timed(p, 1)) / (n - 1) for p in prompts]
+        return sum(per_token) / len(per_token) * 1000
+
+    dynamic = _per_token_ms(False)
+    static = _per_token_ms(True)
+    print(f"dynamic cache : {dynamic:7.2f} ms/token")
+    print(f"static+compile: {static:7.2f} ms/token  x{dynamic / static:.2f}")
+    return 0
+
+
+def bench_adapters(args):
+    """predict_state latency with one adapter vs alternating adapters, plus per-adapter memory."""
+    names = inference.wrapper.adapters
+    if len(names) < 2:
+        print("LORA_ADAPTERS needs at least two adapters")
+        return 1
+    prompts = _prompts(args.n)
+    inference.predict_state(prompts[0], adapter=names[0])  # warm-up
+
+    def _timed(pick):
+        t0 = time.perf_counter()
+        for i, prompt in enumerate(prompts):
+            inference.predict_state(prompt, adapter=pick(i))
+        return (time.perf_counter() - t0) / len(prompts) * 1000
+
+    same = _timed(lambda i: names[0])
+    alternating = _timed(lambda i: names[i % len(names)])
+    print(f"same adapter    : {same:8.1f} ms/call")
+    print(f"alternating     : {alternating:8.1f} ms/call  (+{alternating - same:.1f} ms)")
+
+    t0 = time.perf_counter()
+    inference.predict_state_batch(prompts, adapters=[names[i % len(names)] for i in range(len(prompts))])
+    print(f"mixed batch of {len(prompts)}: {(time.perf_counter() - t0) * 1000:8.1f} ms "
+          f"({len(names)} sub-batches)")
+
+    print(f"{'adapter':16s} {'lora MB':>8s} {'heads MB':>9s} {'load s':>7s} {'switches':>9s} {'ms/switch':>10s}")
+    for name, s in inference.adapter_stats()["adapters"].items():
+        per_switch = s["switch_seconds"] / s["switches"] * 1000 if s["switches"] else 0.0
+        print(f"{name:16s} {s['adapter_mb']:8.2f} {s['heads_mb']:9.2f} {s['load_seconds']:7.2f} "
+              f"{s['switches']:9d} {per_switch:10.3f}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("parity", help="single-pass vs two-pass head outputs")
+    p.add_argument("--max-new-tokens", type=int, default=32)
+    p.set_defaults(fn=bench_parity)
+
+    p = sub.add_parser("batch", help="batched generation throughput")
+    p.add_argument("--sizes", default="1,2,4,8")
+    p.add_argument("--repeat", type=int, default=2)
+    p.add_argument("--max-new-tokens", type=int, default=32)
+    p.set_defaults(fn=bench_batch)
+
+    p = sub.add_parser("prefix", help="prefix KV-cache prefill latency")
+    p.add_argument("--turns", type=int, default=4, help="turns per NPC sharing one header")
+    p.set_defaults(fn=bench_prefix)
+
+    p = sub.add_parser("state", help="heads-only predict_state latency")
+    p.set_defaults(fn=bench_state)
+
+    p = sub.add_parser("choices", help="batched dialogue-choice scoring")
+    p.add_argument("--n", type=int, default=6)
+    p.add_argument("--full", action="store_true", help="also time N full run_inference calls")
+    p.set_defaults(fn=bench_choices)
+
+    p = sub.add_parser("stopping", help="dialogue-aware stopping savings")
+    p.add_argument("--max-new-tokens", type=int, default=400)
+    p.add_argument("--sample", action="store_true", help="use GEN_PARAMS sampling instead of greedy")
+    p.set_defaults(fn=bench_stopping)
+
+    p = sub.add_parser("speculative", help="assisted decoding speedup")
+    p.add_argument("--max-new-tokens", type=int, default=128)
+    p.set_defaults(fn=bench_speculative)
+
+    p = sub.add_parser("static", help="compiled static-cache decode latency")
+    p.add_argument("--max-new-tokens", type=int, default=64)
+    p.set_defaults(fn=bench_static)
+
+    p = sub.add_parser("adapters", help="multi-adapter switch cost and memory")
+    p.add_argument("--n", type=int, default=16)
+    p.set_defaults(fn=bench_adapters)
+
+    args = parser.parse_args()
+    raise SystemExit(args.fn(args))
+
+
+if __name__ == "__main__":
+    main()
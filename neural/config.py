@@ -9,10 +9,24 @@ load_dotenv()
 # Model path (uses default if environment variable is missing)
 BASE_MODEL = os.getenv("BASE_MODEL", "Qwen/Qwen2.5-3B-Instruct")
 ADAPTERS = os.getenv("ADAPTER_MODEL", "m97j/npc_LoRA-fps")
+# Multi-adapter serving on top of BASE_MODEL: "name=repo[/subfolder][@revision],..." (empty = merged checkpoint)
+LORA_ADAPTERS = os.getenv("LORA_ADAPTERS", "")
+
+# Cold start: pinned local copy of the merged checkpoint (empty = snapshot of the branch from the Hub cache)
+MODEL_SNAPSHOT_DIR = os.getenv("MODEL_SNAPSHOT_DIR", "")
+# tokenizer with SPECIALS already added, saved per snapshot
+TOKENIZER_CACHE_DIR = os.getenv("TOKENIZER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "npc_tokenizer"))
+
+# Tiny randomly initialized model of the same architecture + local tokenizer (no Hub access; CI / eval_harness.py)
+TINY_MODEL = os.getenv("TINY_MODEL", "false").lower() == "true"
 
 # Device configuration
 DEVICE = os.getenv("DEVICE", "cuda" if torch.cuda.is_available() else "cpu")
 
+# Base model precision: "fp32" | "bf16" | "int8" (dynamic int8 Linear layers, CPU only)
+# custom heads (delta/flag/flag_threshold) always stay fp32
+PRECISION = os.getenv("PRECISION", "fp32").lower()
+
 # Tokenizer/Model common parameters
 MAX_LENGTH = int(os.getenv("MAX_LENGTH", 1024))
 NUM_FLAGS = int(os.getenv("NUM_FLAGS", 7))  # match withflags.json
@@ -22,5 +36,44 @@ GEN_MAX_NEW_TOKENS = int(os.getenv("GEN_MAX_NEW_TOKENS", 400))
 GEN_TEMPERATURE = float(os.getenv("GEN_TEMPERATURE", 0.7))
 GEN_TOP_P = float(os.getenv("GEN_TOP_P", 0.9))
 
+# Speculative (assisted) decoding: small draft model with a compatible tokenizer ("" disables)
+DRAFT_MODEL = os.getenv("DRAFT_MODEL", "")  # e.g. "Qwen/Qwen2.5-0.5B-Instruct"
+DRAFT_NUM_TOKENS = int(os.getenv("DRAFT_NUM_TOKENS", 5))  # tokens proposed per verification step
+
+# Dialogue-aware stopping (end the NPC line once it is complete)
+STOP_ON_SPECIALS = os.getenv("STOP_ON_SPECIALS", "true").lower() == "true"  # <PLAYER>/<CTX>/<SYS>/...
+STOP_NEWLINE = os.getenv("STOP_NEWLINE", "blank")  # "blank" | "any" | "off"
+STOP_MAX_SENTENCES = int(os.getenv("STOP_MAX_SENTENCES", 0))  # 0 = no limit
+
+# Static-shape decoding: preallocated StaticCache (MAX_LENGTH + GEN_MAX_NEW_TOKENS) and a
+# torch.compile'd decode step, compiled and warmed up at load time
+STATIC_DECODE = os.getenv("STATIC_DECODE", "false").lower() == "true"
+# Upper bound of the StaticCache memory (one cache per batch size, least recently used evicted first)
+STATIC_CACHE_MAX_MB = int(os.getenv("STATIC_CACHE_MAX_MB", 1024))
+
+# Reuse the prefill hidden states of generate() for the custom heads
+# (set to "false" to fall back to a second full forward pass)
+SINGLE_PASS_HEADS = os.getenv("SINGLE_PASS_HEADS", "true").lower() == "true"
+
+# Dynamic micro-batching (request coalescer in front of run_inference_batch)
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 8))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 10))
+
+# Prefix KV-cache for the constant <SYS>/<RAG>/<PLAYER_STATE> header (0 disables)
+PREFIX_CACHE_MAX_MB = int(os.getenv("PREFIX_CACHE_MAX_MB", 1024))
+PREFIX_CACHE_MARKER = os.getenv("PREFIX_CACHE_MARKER", "<CTX>")  # header ends right before this token
+
+# Response cache for deterministic requests (greedy, or sampling with a "seed"); 0 disables
+RESPONSE_CACHE_MAX_MB = int(os.getenv("RESPONSE_CACHE_MAX_MB", 0))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")  # optional on-disk tier, kept across restarts
+
+# HTTP server (server.py): bounded request queue in front of the single inference thread
+SERVE_PORT = int(os.getenv("SERVE_PORT", 7860))
+SERVE_QUEUE_MAX = int(os.getenv("SERVE_QUEUE_MAX", 16))  # queued requests before 503
+SERVE_MAX_WAIT_S = float(os.getenv("SERVE_MAX_WAIT_S", 20))  # estimated queue wait before 503 (< symbolic HF_TIMEOUT)
+# Multi-replica CPU serving (replicas.py): forked copies of the loaded model, each on its own cores
+REPLICAS = int(os.getenv("REPLICAS", 1))
+REPLICA_THREADS = int(os.getenv("REPLICA_THREADS", 0))  # torch threads per replica, 0 = its share of the cores
+
 # Hugging Face Token (For Private Model Access)
 HF_TOKEN = os.getenv("HF_TOKEN")
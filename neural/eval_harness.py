@@ -0,0 +1,222 @@
+"""
+Offline evaluation / throughput harness over test_cases.json.
+
+    python eval_harness.py run --out report.json --csv report.csv --batch-size 4 --repeat 3
+    python eval_harness.py run --tiny --out tiny.json          # random tiny model, no Hub access
+    python eval_harness.py compare base.json new.json          # exit code 1 on regressions
+
+Per case (and repeat) the report keeps prefill / decode time, generated tokens, tokens/sec,
+peak RSS so far and the head outputs. Generation is greedy unless --sample is given.
+The response cache is switched off for the run, so repeated prompts are always generated.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import resource
+import time
+
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _quantiles(values) -> dict:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0}
+    ordered = sorted(values)
+    return {
+        "p50": round(ordered[len(ordered) // 2], 2),
+        "p95": round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 2),
+    }
+
+
+def run(args):
+    if args.tiny:
+        os.environ["TINY_MODEL"] = "true"  # read by config at import
+    import inference
+    import torch
+    from config import DEVICE
+    from modules.case_loader import load_cases
+    from webtest_prompt import _assemble_prompt_for_model
+
+    # every case and repeat must really run: no answers from the response cache (RESPONSE_CACHE_MAX_MB)
+    inference.response_cache.max_bytes = 0
+    cases = load_cases()
+    prompts = [_assemble_prompt_for_model(c["input"]) for c in cases]
+    params = {"max_new_tokens": args.max_new_tokens}
+    if args.sample:
+        params["do_sample"] = True
+    else:
+        params.update(do_sample=False, temperature=None, top_p=None)
+
+    inference.run_inference(prompts[0], gen_params={**params, "max_new_tokens": 1})  # warm-up
+
+    rows = []
+    wall_start = time.perf_counter()
+    for rep in range(args.repeat):
+        for start in range(0, len(prompts), args.batch_size):
+            idx = list(range(start, min(start + args.batch_size, len(prompts))))
+            t0 = time.perf_counter()
+            results = inference.run_inference_batch(
+                [prompts[i] for i in idx], gen_params=params, stopping=not args.no_stopping
+            )
+            wall = time.perf_counter() - t0
+            rss = _peak_rss_mb()
+            for i, result in zip(idx, results):
+                timing = result["timing"]
+                decode_s = timing["decode_ms"] / 1000
+                rows.append({
+                    "case": i,
+                    "description": cases[i]["input"].get("description", ""),
+                    "repeat": rep,
+                    "batch_size": len(idx),
+                    "prefill_ms": timing["prefill_ms"],
+                    "decode_ms": timing["decode_ms"],
+                    "wall_ms": round(wall * 1000, 2),
+                    "new_tokens": timing["new_tokens"],
+                    "tokens_per_sec": round(timing["new_tokens"] / decode_s, 3) if decode_s else 0.0,
+                    "peak_rss_mb": round(rss, 1),
+                    "stop_reason": result.get("stop_reason"),
+                    "npc_output_text": result["npc_output_text"],
+                    "deltas": result["deltas"],
+                    "flags_prob": result["flags_prob"],
+                    "flags_thr": result["flags_thr"],
+                })
+    wall_total = time.perf_counter() - wall_start
+
+    total_tokens = sum(r["new_tokens"] for r in rows)
+    report = {
+        "meta": {
+            "branch": inference.wrapper.branch,
+            "precision": inference.wrapper.precision,
+            "tiny": args.tiny,
+            "batch_size": args.batch_size,
+            "repeat": args.repeat,
+            "gen_params": params,
+            "device": DEVICE,
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "summary": {
+            "runs": len(rows),
+            "total_tokens": total_tokens,
+            "tokens_per_sec": round(total_tokens / wall_total, 3) if wall_total else 0.0,
+            "prefill_ms": _quantiles([r["prefill_ms"] for r in rows]),
+            "decode_ms": _quantiles([r["decode_ms"] for r in rows]),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+        },
+        "cases": rows,
+    }
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.csv:
+        _write_csv(args.csv, rows, inference.flags_order)
+
+    s = report["summary"]
+    print(f"{s['runs']} runs, {s['total_tokens']} tokens, {s['tokens_per_sec']:.2f} tok/s, "
+          f"prefill p50 {s['prefill_ms']['p50']:.1f}ms, decode p50 {s['decode_ms']['p50']:.1f}ms, "
+          f"peak RSS {s['peak_rss_mb']:.0f}MB -> {args.out}")
+    return 0
+
+
+def _write_csv(path, rows, flags_order):
+    scalar = ["case", "repeat", "batch_size", "prefill_ms", "decode_ms", "wall_ms", "new_tokens",
+              "tokens_per_sec", "peak_rss_mb", "stop_reason"]
+    header = scalar + ["delta_trust", "delta_relationship"] + [f"flag_{name}" for name in flags_order]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for r in rows:
+            writer.writerow(
+                [r[k] for k in scalar]
+                + [r["deltas"]["trust"], r["deltas"]["relationship"]]
+                + [r["flags_prob"].get(name) for name in flags_order]
+            )
+
+
+def _head_drift(base_rows, new_rows) -> float:
+    """Max abs difference of deltas / flag probs / thresholds over runs present in both reports."""
+    new_by_key = {(r["case"], r["repeat"]): r for r in new_rows}
+    drift = 0.0
+    for b in base_rows:
+        n = new_by_key.get((b["case"], b["repeat"]))
+        if n is None:
+            continue
+        for key in ("deltas", "flags_prob", "flags_thr"):
+            for name, value in b[key].items():
+                if name in n[key]:
+                    drift = max(drift, abs(value - n[key][name]))
+    return drift
+
+
+def compare(args):
+    with open(args.base, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    b, n = base["summary"], new["summary"]
+    tol = args.tolerance
+
+    # (metric, base, new, True if higher is better)
+    checks = [
+        ("tokens_per_sec", b["tokens_per_sec"], n["tokens_per_sec"], True),
+        ("prefill_ms p50", b["prefill_ms"]["p50"], n["prefill_ms"]["p50"], False),
+        ("prefill_ms p95", b["prefill_ms"]["p95"], n["prefill_ms"]["p95"], False),
+        ("decode_ms p50", b["decode_ms"]["p50"], n["decode_ms"]["p50"], False),
+        ("decode_ms p95", b["decode_ms"]["p95"], n["decode_ms"]["p95"], False),
+        ("peak_rss_mb", b["peak_rss_mb"], n["peak_rss_mb"], False),
+    ]
+    regressions = 0
+    print(f"{'metric':16s} {'base':>10s} {'new':>10s} {'change':>8s}")
+    for name, old, cur, higher_better in checks:
+        change = (cur - old) / old if old else 0.0
+        worse = -change if higher_better else change
+        flag = ""
+        if worse > tol:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:16s} {old:10.2f} {cur:10.2f} {change * 100:+7.1f}%{flag}")
+
+    drift = _head_drift(base["cases"], new["cases"])
+    flag = ""
+    if drift > args.head_tolerance:
+        flag = "  REGRESSION"
+        regressions += 1
+    print(f"{'head drift':16s} {'':10s} {drift:10.4f} {'':8s}{flag}")
+    if base["meta"].get("gen_params") != new["meta"].get("gen_params"):
+        print("[WARN] reports were made with different gen_params")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("run", help="run every test case and write a report")
+    p.add_argument("--out", default="eval_report.json")
+    p.add_argument("--csv", default=None)
+    p.add_argument("--batch-size", type=int, default=1)
+    p.add_argument("--repeat", type=int, default=1)
+    p.add_argument("--max-new-tokens", type=int, default=64)
+    p.add_argument("--sample", action="store_true", help="use GEN_PARAMS sampling instead of greedy")
+    p.add_argument("--no-stopping", action="store_true", help="disable dialogue-aware stopping")
+    p.add_argument("--tiny", action="store_true", help="random tiny model + local tokenizer (TINY_MODEL)")
+    p.set_defaults(fn=run)
+
+    p = sub.add_parser("compare", help="compare two reports")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--tolerance", type=float, default=0.10, help="relative slowdown / growth allowed")
+    p.add_argument("--head-tolerance", type=float, default=0.05, help="max abs head output drift allowed")
+    p.set_defaults(fn=compare)
+
+    args = parser.parse_args()
+    raise SystemExit(args.fn(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,46 @@
+import copy
+import functools
+import gc
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Thread
+
 import torch
-from config import (DEVICE, GEN_MAX_NEW_TOKENS, GEN_TEMPERATURE, GEN_TOP_P,
-                    MAX_LENGTH)
-from model_loader import ModelWrapper
+from config import (BATCH_MAX_SIZE, DEVICE, DRAFT_MODEL, DRAFT_NUM_TOKENS, GEN_MAX_NEW_TOKENS,
+                    GEN_TEMPERATURE, GEN_TOP_P, MAX_LENGTH,
+                    PREFIX_CACHE_MARKER, PREFIX_CACHE_MAX_MB,
+                    RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_MB, SINGLE_PASS_HEADS,
+                    STATIC_CACHE_MAX_MB, STATIC_DECODE, STOP_MAX_SENTENCES, STOP_NEWLINE,
+                    STOP_ON_SPECIALS)
+from model_loader import (build_wrapper, fixed_snapshot, load_draft_model,
+                          parse_adapter_specs, set_current_branch)
+from prefix_cache import PrefixKVCache
+from prompt_budget import fit_prompt
+from response_cache import ResponseCache
+from stopping import DialogueStopper
+from transformers import (LogitsProcessor, LogitsProcessorList, StaticCache,
+                          StoppingCriteriaList, TemperatureLogitsWarper,
+                          TextIteratorStreamer, TopKLogitsWarper,
+                          TopPLogitsWarper)
+from webtest_prompt import _assemble_prompt_for_model
 
 # Global Load (once at server start)
-wrapper = ModelWrapper()
+wrapper = build_wrapper()
 tokenizer, model, flags_order = wrapper.get()
+prefix_cache = PrefixKVCache(PREFIX_CACHE_MAX_MB * 1024 * 1024)
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_MB * 1024 * 1024, RESPONSE_CACHE_DIR)
+
+# Hot-swap state: every request is pinned to the wrapper it started on (thread-local),
+# reload_model() swaps `wrapper` under _swap_lock and releases the old one once drained.
+_local = threading.local()
+_swap_lock = threading.Lock()
+_inflight = {}  # id(wrapper) -> running requests
+_inflight_lock = threading.Lock()
+_reload = {"state": "idle", "branch": wrapper.branch}
 
 GEN_PARAMS = {
     "max_new_tokens": GEN_MAX_NEW_TOKENS,
@@ -15,50 +50,887 @@ GEN_PARAMS = {
     "repetition_penalty": 1.05,
 }
 
-def run_inference(prompt: str):
-    inputs = tokenizer(prompt, return_tensors="pt", truncation=True, max_length=MAX_LENGTH).to(DEVICE)
+# Speculative decoding: the draft proposes DRAFT_NUM_TOKENS tokens, the main model verifies
+# them in one pass (single-prompt requests only; pass gen_params={"assistant_model": None} to disable)
+draft_model = load_draft_model(DRAFT_MODEL, tokenizer, DRAFT_NUM_TOKENS) if DRAFT_MODEL else None
+_spec_stats = {"requests": 0, "new_tokens": 0, "target_forwards": 0, "draft_forwards": 0}
+_spec_lock = threading.Lock()
+
+# Static-shape decoding (STATIC_DECODE): a StaticCache per batch size (allocated on first use,
+# at most STATIC_CACHE_MAX_MB in total) and a compiled decode step; `static_decode` switches it off at runtime (e.g. for benchmarks)
+STATIC_CACHE_LEN = MAX_LENGTH + GEN_MAX_NEW_TOKENS
+static_decode = STATIC_DECODE
+
+# Section-aware prompt budgeting (replaces tail truncation at MAX_LENGTH)
+_budget_stats = {"prompts": 0, "trimmed": 0, "saved": {}}
+_budget_lock = threading.Lock()
+
+def _engine():
+    """The ModelWrapper serving this thread's request, else the active one."""
+    return getattr(_local, "wrapper", None) or wrapper
+
+@contextmanager
+def _pinned(w=None):
+    """Pin a wrapper to the current thread (and count it in flight) for one request."""
+    prev = getattr(_local, "wrapper", None)
+    w = w or prev or wrapper
+    _local.wrapper = w
+    with _inflight_lock:
+        _inflight[id(w)] = _inflight.get(id(w), 0) + 1
+    try:
+        yield w
+    finally:
+        with _inflight_lock:
+            _inflight[id(w)] -= 1
+            if not _inflight[id(w)]:
+                del _inflight[id(w)]
+        _local.wrapper = prev
+
+def _request(fn):
+    # public entry points run entirely on the wrapper that was active when they started
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        with _pinned():
+            return fn(*args, **kwargs)
+    return inner
+
+def _adapter_groups(adapters, n):
+    """{adapter name: [row indices]} for adapters = None, one name, or one name per prompt."""
+    if adapters is None or isinstance(adapters, str):
+        return {adapters: list(range(n))}
+    adapters = list(adapters)
+    if len(adapters) != n:
+        raise ValueError(f"Got {len(adapters)} adapter names for {n} prompts")
+    groups = {}
+    for i, name in enumerate(adapters):
+        groups.setdefault(name, []).append(i)
+    return groups
+
+def _per_adapter(fn, prompts, adapters, **kwargs):
+    # one sub-batch per adapter (active for the whole call), results back in input order
+    results = [None] * len(prompts)
+    for name, rows in _adapter_groups(adapters, len(prompts)).items():
+        with _engine().use_adapter(name):
+            for i, result in zip(rows, fn([prompts[i] for i in rows], **kwargs)):
+                results[i] = result
+    return results
+
+def _encode_ids(prompts):
+    """
+    Token ids of each prompt within MAX_LENGTH (see prompt_budget.fit_prompt): the closing
+    <PLAYER>/<STATE>/<NPC> part is always kept, RAG and the oldest CTX lines are trimmed first.
+    Returns (ids list, trim report per prompt or None).
+    """
+    tokenizer = _engine().tokenizer
+    fitted = [fit_prompt(p, tokenizer, MAX_LENGTH) for p in prompts]
+    reports = [report for _, report in fitted]
+    with _budget_lock:
+        _budget_stats["prompts"] += len(prompts)
+        for report in filter(None, reports):
+            _budget_stats["trimmed"] += 1
+            for name, n in report["saved"].items():
+                _budget_stats["saved"][name] = _budget_stats["saved"].get(name, 0) + n
+    return [ids for ids, _ in fitted], reports
+
+def _pad(ids):
+    # left-padded batch
+    return _engine().tokenizer.pad({"input_ids": ids}, return_tensors="pt").to(DEVICE)
+
+def _encode(prompts):
+    # left-padded batch of budgeted prompts
+    ids, reports = _encode_ids(prompts)
+    return _pad(ids), reports
+
+def _attach_trim(results, reports):
+    for result, report in zip(results, reports):
+        if report is not None:
+            result["prompt_trim"] = report
+    return results
+
+def budget_stats():
+    """Prompts seen, prompts trimmed and tokens saved per section."""
+    with _budget_lock:
+        return {**_budget_stats, "saved": dict(_budget_stats["saved"])}
+
+def _final_norm(m):
+    """Return the decoder's final norm layer (its output == hidden_states[-1]), or None."""
+    decoder = m.get_decoder() if hasattr(m, "get_decoder") else None
+    return getattr(decoder, "norm", None)
+
+@contextmanager
+def _capture_prefill_hidden(norm, on_prefill=None):
+    """
+    Hook the final norm during generate() and keep only its first output,
+    i.e. the last-layer hidden states of the prompt prefill step.
+    on_prefill(h) is called as soon as the prefill is done (before any token is decoded).
+    """
+    captured = {}
+
+    def _hook(module, args, output):
+        if "h" not in captured:
+            captured["h"] = output
+            if on_prefill is not None:
+                on_prefill(output)
+
+    handle = norm.register_forward_hook(_hook)
+    try:
+        yield captured
+    finally:
+        handle.remove()
+
+class _GumbelSampler(LogitsProcessor):
+    """
+    Sampling from a private torch.Generator: argmax(scores + Gumbel noise) is a sample from
+    softmax(scores), so greedy search over the warped scores plus this noise samples without
+    touching torch's global RNG (which generate(do_sample=True) shares across threads).
+    """
+
+    def __init__(self, seed: int):
+        self.generator = torch.Generator(device=DEVICE).manual_seed(seed)
+
+    def __call__(self, input_ids, scores):
+        u = torch.rand(scores.shape, generator=self.generator, device=scores.device).clamp_min(1e-20)
+        return scores.float() - torch.log(-torch.log(u))
+
+def _seeded(params):
+    """
+    Pop "seed" from gen params; a seeded sampled run becomes greedy search over temperature /
+    top-k / top-p warped scores plus _GumbelSampler noise, so it is reproducible and needs no
+    lock around the global RNG.
+    """
+    seed = params.pop("seed", None)
+    if seed is None or not params.get("do_sample"):
+        return params
+    processors = LogitsProcessorList(params.pop("logits_processor", None) or [])
+    temperature, top_k, top_p = params.pop("temperature", None), params.pop("top_k", None), params.pop("top_p", None)
+    if temperature is not None and temperature != 1.0:
+        processors.append(TemperatureLogitsWarper(temperature))
+    if top_k:
+        processors.append(TopKLogitsWarper(top_k))
+    if top_p is not None and top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p))
+    processors.append(_GumbelSampler(seed))
+    params.update(do_sample=False, logits_processor=processors)
+    return params
+
+@contextmanager
+def _first_pass_time(norm):
+    """{"t": perf_counter} of the moment the first decoder pass (the prefill) reaches `norm`."""
+    mark = {}
+    if norm is None:
+        yield mark
+        return
+
+    def _hook(module, args, output):
+        mark.setdefault("t", time.perf_counter())
+
+    handle = norm.register_forward_hook(_hook)
+    try:
+        yield mark
+    finally:
+        handle.remove()
+
+def _pool_state(h, ids):
+    # <STATE> token position pooling (per row; rows without <STATE> use their last token)
+    # assisted generation verifies prompt + draft tokens in its first pass: keep the prompt part
+    h = h[:, :ids.shape[1]]
+    STATE_ID = _engine().tokenizer.convert_tokens_to_ids("<STATE>")
+    mask = (ids == STATE_ID).unsqueeze(-1)
+    counts = mask.sum(dim=1)
+    pooled = (h * mask).sum(dim=1) / counts.clamp_min(1)
+    return torch.where(counts > 0, pooled, h[:, -1, :])
+
+def _position_ids(attention_mask):
+    # same positions generate() derives for left-padded rows
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    return position_ids.masked_fill(attention_mask == 0, 1)
+
+def _with_draft(params, batch_size):
+    # assisted generation handles one row at a time
+    if draft_model is not None and batch_size == 1 and "assistant_model" not in params:
+        params["assistant_model"] = draft_model
+    return params
+
+@contextmanager
+def _count_forwards(**modules):
+    counts = dict.fromkeys(modules, 0)
+    handles = []
+    for name, module in modules.items():
+        def _hook(m, args, output, name=name):
+            counts[name] += 1
+        handles.append(module.register_forward_hook(_hook))
+    try:
+        yield counts
+    finally:
+        for handle in handles:
+            handle.remove()
+
+def _cache_layers(cache):
+    """[(keys, values), ...] per layer of a DynamicCache (any transformers version) or legacy tuples."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [tuple(layer) for layer in cache]
+
+def _new_static_cache(model, batch_size):
+    try:
+        return StaticCache(config=model.config, max_batch_size=batch_size, max_cache_len=STATIC_CACHE_LEN,
+                           device=DEVICE, dtype=model.dtype)
+    except TypeError:  # newer transformers size the batch on first use
+        return StaticCache(config=model.config, max_cache_len=STATIC_CACHE_LEN)
+
+def _static_cache_mb(model, batch_size) -> float:
+    # keys + values of every layer at STATIC_CACHE_LEN
+    cfg = model.config
+    kv_heads = getattr(cfg, "num_key_value_heads", None) or cfg.num_attention_heads
+    head_dim = getattr(cfg, "head_dim", None) or cfg.hidden_size // cfg.num_attention_heads
+    elements = 2 * cfg.num_hidden_layers * batch_size * kv_heads * STATIC_CACHE_LEN * head_dim
+    return elements * torch.finfo(model.dtype).bits / 8 / 2 ** 20
+
+@contextmanager
+def _static_cache(inputs, gen_params, prefix=None):
+    """
+    The StaticCache for this batch size, reset and filled with the prefix KV (if any), held
+    for one generate(). Caches are allocated on first use and the least recently used ones
+    are dropped to stay within STATIC_CACHE_MAX_MB. Yields None when the static path doesn't apply.
+    """
+    w = _engine()
+    batch_size, prompt_len = inputs["input_ids"].shape
+    max_new = gen_params.get("max_new_tokens") or GEN_MAX_NEW_TOKENS
+    if (not static_decode or not getattr(w, "static_decode", False)
+            or gen_params.get("assistant_model") is not None or prompt_len + max_new > STATIC_CACHE_LEN):
+        yield None
+        return
+    with w.static_lock:
+        entry = w.static_caches.pop(batch_size, None)
+        if entry is None:
+            size_mb = _static_cache_mb(w.model, batch_size)
+            while w.static_caches and sum(mb for _, mb in w.static_caches.values()) + size_mb > STATIC_CACHE_MAX_MB:
+                w.static_caches.popitem(last=False)
+            entry = (_new_static_cache(w.model, batch_size), size_mb)
+        w.static_caches[batch_size] = entry  # most recently used last
+        cache = entry[0]
+        cache.reset()
+        if prefix is not None:
+            for layer_idx, (k, v) in enumerate(_cache_layers(prefix)):
+                positions = torch.arange(k.shape[-2], device=k.device)
+                cache.update(k, v, layer_idx, {"cache_position": positions})
+        yield cache
+
+def _generate(inputs, gen_params, cache=None):
+    model = _engine().model
+    with _static_cache(inputs, gen_params, cache) as static:
+        if static is not None:
+            try:
+                return model.generate(**inputs, past_key_values=static, **gen_params)
+            except Exception as e:
+                # e.g. a batch size the backend can't compile: dynamic decoding from now on
+                print(f"[WARN] Static decode failed, falling back to the dynamic cache: {e}")
+                _disable_static(_engine())
+                for criterion in gen_params.get("stopping_criteria") or ():
+                    if isinstance(criterion, DialogueStopper):
+                        criterion.reset()  # stop reasons of the failed attempt
+
+    extra = {"past_key_values": cache} if cache is not None else {}
+    draft = gen_params.get("assistant_model")
+    if draft is None:
+        return model.generate(**inputs, **extra, **gen_params)
+
+    with _count_forwards(target_forwards=model, draft_forwards=draft) as counts:
+        gen_ids = model.generate(**inputs, **extra, **gen_params)
+    with _spec_lock:
+        _spec_stats["requests"] += 1
+        _spec_stats["new_tokens"] += gen_ids.shape[1] - inputs["input_ids"].shape[1]
+        _spec_stats["target_forwards"] += counts["target_forwards"]
+        _spec_stats["draft_forwards"] += counts["draft_forwards"]
+    return gen_ids
+
+def speculative_stats():
+    """
+    Assisted-decoding counters. Every main-model pass yields one token of its own,
+    so accepted draft tokens ~= new_tokens - target_forwards, out of draft_forwards proposed.
+    """
+    with _spec_lock:
+        stats = dict(_spec_stats)
+    accepted = max(0, stats["new_tokens"] - stats["target_forwards"])
+    stats["enabled"] = draft_model is not None
+    stats["acceptance_rate"] = round(accepted / stats["draft_forwards"], 4) if stats["draft_forwards"] else 0.0
+    stats["tokens_per_target_forward"] = (
+        round(stats["new_tokens"] / stats["target_forwards"], 3) if stats["target_forwards"] else 0.0
+    )
+    return stats
+
+def _generate_with_state(inputs, gen_params, single_pass=SINGLE_PASS_HEADS, past=None):
+    """
+    Run generate() and return (gen_ids, pooled <STATE> vectors).
+    single_pass=True pulls the hidden states from the prefill generate() already does;
+    otherwise (or if the model has no final norm to hook) a second forward pass is used.
+    past=(prefix_len, past_key_values) continues from a cached prompt prefix,
+    so only the tokens after prefix_len are prefilled.
+    """
+    start, cache = past if past is not None else (0, None)
+    model = _engine().model
+
+    norm = _final_norm(model) if single_pass else None
+    if norm is not None:
+        with _capture_prefill_hidden(norm) as captured:
+            gen_ids = _generate(inputs, gen_params, cache)
+        h = captured["h"]
+    else:
+        # generate() extends the cache in place, keep a copy for the second pass
+        second_cache = copy.deepcopy(cache) if cache is not None else None
+        gen_ids = _generate(inputs, gen_params, cache)
+        outputs = model(
+            input_ids=inputs["input_ids"][:, start:],
+            attention_mask=inputs["attention_mask"],
+            position_ids=_position_ids(inputs["attention_mask"])[:, start:],
+            past_key_values=second_cache,
+            output_hidden_states=True,
+        )
+        h = outputs.hidden_states[-1]
+
+    return gen_ids, _pool_state(h, inputs["input_ids"][:, start:])
+
+def _prefix_past(input_ids):
+    """
+    Look up (or build) the cached past_key_values of the prompt header, i.e. every
+    token before PREFIX_CACHE_MARKER. Returns (prefix_len, past_key_values) or None.
+    Single rows only: in a left-padded batch every header starts at a different offset,
+    so batched requests (run_inference_batch with >1 prompt, the server's coalesced
+    batches) prefill the full prompt. score_choices() and streaming are single-row here.
+    """
+    w = _engine()
+    marker_id = w.tokenizer.convert_tokens_to_ids(PREFIX_CACHE_MARKER)
+    positions = (input_ids[0] == marker_id).nonzero()
+    # requests still finishing on a swapped-out model don't touch the cache
+    if not prefix_cache.enabled or w is not wrapper or len(positions) == 0 or int(positions[0]) == 0:
+        return None
+
+    prefix_len = int(positions[0])
+    prefix_ids = input_ids[:, :prefix_len]
+    key = prefix_cache.key(prefix_ids, namespace=getattr(w, "active_adapter", None) or "")
+    past = prefix_cache.get(key)
+    if past is None:
+        _, past = _decoder_forward(input_ids=prefix_ids, use_cache=True)  # no vocab-sized logits
+        with _swap_lock:
+            if w is wrapper:
+                prefix_cache.put(key, past)
+        past = copy.deepcopy(past)  # the cached entry must stay header-only
+    return prefix_len, past
+
+def _format_states(pooled):
+    # delta, flag, flag_threshold prediction (one dict per row); heads are fp32
+    _, model, flags_order = _engine().get()
+    pooled = pooled.float()
+    delta_pred = torch.tanh(model.delta_head(pooled)).cpu().tolist()
+    flag_prob = torch.sigmoid(model.flag_head(pooled)).cpu().tolist()
+    flag_thr = torch.sigmoid(model.flag_threshold_head(pooled)).cpu().tolist()
+
+    states = []
+    for delta, probs, thrs in zip(delta_pred, flag_prob, flag_thr):
+        states.append({
+            "deltas": {
+                "trust": float(delta[0]),
+                "relationship": float(delta[1]),
+            },
+            "flags_prob": {name: round(prob, 6) for name, prob in zip(flags_order, probs)},
+            "flags_thr": {name: round(thr, 6) for name, thr in zip(flags_order, thrs)},
+        })
+    return states
+
+def _format_results(generated_texts, pooled):
+    return [
+        {"npc_output_text": text.strip(), **state}
+        for text, state in zip(generated_texts, _format_states(pooled))
+    ]
+
+def _decoder_forward(**kwargs):
+    """
+    Forward through the decoder stack only (no vocab-sized logits).
+    Returns (last-layer hidden states, past_key_values).
+    """
+    model = _engine().model
+    decoder = model.get_decoder() if hasattr(model, "get_decoder") else None
+    if decoder is not None:
+        outputs = decoder(**kwargs)
+        return outputs.last_hidden_state, outputs.past_key_values
+    outputs = model(**kwargs, output_hidden_states=True)
+    return outputs.hidden_states[-1], outputs.past_key_values
+
+def _prefill_state(inputs, past=None):
+    """Single prefill forward (no generation) and pooled <STATE> vectors."""
+    start, cache = past if past is not None else (0, None)
+    h, _ = _decoder_forward(
+        input_ids=inputs["input_ids"][:, start:],
+        attention_mask=inputs["attention_mask"],
+        position_ids=_position_ids(inputs["attention_mask"])[:, start:],
+        past_key_values=cache,
+    )
+    return _pool_state(h, inputs["input_ids"][:, start:])
+
+@_request
+def predict_state_batch(prompts, adapters=None):
+    """
+    Heads-only prediction for several prompts: one batched prefill, no text generation.
+    adapters: see run_inference_batch().
+    Returns [{"deltas": ..., "flags_prob": ..., "flags_thr": ...}, ...].
+    """
+    if not prompts:
+        return []
+    return _per_adapter(_predict_batch, list(prompts), adapters)
+
+def _predict_batch(prompts):
+    inputs, reports = _encode(prompts)
+
+    with torch.no_grad():
+        past = _prefix_past(inputs["input_ids"]) if len(prompts) == 1 else None
+        return _attach_trim(_format_states(_prefill_state(inputs, past=past)), reports)
+
+def predict_state(prompt: str, adapter: str = None):
+    return predict_state_batch([prompt], adapters=adapter)[0]
+
+def _common_prefix_len(seqs) -> int:
+    n = min(len(x) for x in seqs)
+    for i in range(n):
+        if any(x[i] != seqs[0][i] for x in seqs):
+            return i
+    return n
+
+def _expand_cache(cache, n):
+    # repeat a batch-1 cache for n rows
+    if hasattr(cache, "batch_repeat_interleave"):
+        cache.batch_repeat_interleave(n)
+        return cache
+    return tuple(tuple(t.repeat_interleave(n, dim=0) for t in layer) for layer in cache)
+
+@_request
+def score_choices(pre: dict, candidates, adapter: str = None):
+    """
+    Predict the consequence (deltas/flags) of each candidate <PLAYER> utterance
+    for one shared prompt context `pre` (see _assemble_prompt_for_model), with `adapter`.
+    The shared token prefix is prefilled once (header from the prefix cache),
+    then all candidate suffixes go through one batched prefill.
+    Returns [{"player_utterance": ..., "deltas": ..., "flags_prob": ..., "flags_thr": ...}, ...].
+    """
+    candidates = list(candidates)
+    if not candidates:
+        return []
+    with _engine().use_adapter(adapter):
+        return _score_choices(pre, candidates)
+
+def _score_choices(pre: dict, candidates):
+    tokenizer = _engine().tokenizer
+    prompts = [_assemble_prompt_for_model({**pre, "player_utterance": c}) for c in candidates]
+    ids, reports = _encode_ids(prompts)
+    # the shared part ends before the last <PLAYER> (the candidate-dependent <PLAYER> ... <STATE> <NPC>
+    # segment), also when there is one candidate or they are identical and the common prefix is everything
+    player_id = tokenizer.convert_tokens_to_ids("<PLAYER>")
+    ends = [len(x) - 1 - x[::-1].index(player_id) if player_id in x else len(x) - 1 for x in ids]
+    shared_len = min(_common_prefix_len(ids), *ends)
 
     with torch.no_grad():
-        # language generation
-        gen_ids = model.generate(**inputs, **GEN_PARAMS)
-        generated_text = tokenizer.decode(
-            gen_ids[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True
+        # 1) shared prefix, once
+        shared = torch.tensor([ids[0][:shared_len]], device=DEVICE)
+        past = _prefix_past(shared) if shared_len else None
+        start, cache = past if past is not None else (0, None)
+        if shared_len > start:
+            _, cache = _decoder_forward(input_ids=shared[:, start:], past_key_values=cache, use_cache=True)
+        if cache is not None:
+            cache = _expand_cache(cache, len(candidates))
+
+        # 2) candidate suffixes, one right-padded batch
+        suffixes = [x[shared_len:] for x in ids]
+        width = max(len(x) for x in suffixes)
+        pad_id = tokenizer.pad_token_id
+        suffix_ids = torch.tensor([x + [pad_id] * (width - len(x)) for x in suffixes], device=DEVICE)
+        suffix_mask = torch.tensor([[1] * len(x) + [0] * (width - len(x)) for x in suffixes], device=DEVICE)
+        attention_mask = torch.cat(
+            [torch.ones(len(candidates), shared_len, dtype=suffix_mask.dtype, device=DEVICE), suffix_mask], dim=1
+        )
+        position_ids = (shared_len + torch.arange(width, device=DEVICE)).expand(len(candidates), -1)
+        h, _ = _decoder_forward(
+            input_ids=suffix_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
         )
+        states = _format_states(_pool_state(h, suffix_ids))
 
-        # hidden state extraction
-        outputs = model(**inputs, output_hidden_states=True)
-        h = outputs.hidden_states[-1]
+    results = [{"player_utterance": c, **state} for c, state in zip(candidates, states)]
+    return _attach_trim(results, reports)
+
+def _eos_ids():
+    tokenizer, model, _ = _engine().get()
+    eos = model.generation_config.eos_token_id
+    ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+    ids.add(tokenizer.eos_token_id)
+    return {i for i in ids if i is not None}
+
+@_request
+def run_inference_batch(prompts, gen_params: dict = None, single_pass: bool = SINGLE_PASS_HEADS,
+                        stopping: bool = True, adapters=None):
+    """
+    Generate for several prompts at once (left-padded) and return one result dict
+    per prompt, in the same shape as run_inference().
+    stopping=True ends each utterance early via DialogueStopper; its reason is
+    reported as "stop_reason".
+    adapters: None (default adapter), one adapter name, or one name per prompt
+    (with LORA_ADAPTERS); a mixed batch runs as one sub-batch per adapter.
+    gen_params may carry a "seed" for reproducible sampling. Deterministic requests are
+    served from the response cache when RESPONSE_CACHE_MAX_MB is set ("cached": True).
+    """
+    if not prompts:
+        return []
+    return _per_adapter(
+        _run_batch, list(prompts), adapters, gen_params=gen_params, single_pass=single_pass, stopping=stopping
+    )
+
+def _response_keys(ids, params, single_pass, stopping):
+    """
+    Response-cache key per row, or None where the output isn't reproducible: only greedy
+    rows, or sampled single prompts with a "seed", are cached. The key covers the exact
+    token ids, the loaded model (snapshot / branch), the adapter and every generation setting.
+    """
+    w = _engine()
+    seeded = "seed" in params and len(ids) == 1
+    if not response_cache.enabled or (params.get("do_sample") and not seeded) or w is not wrapper:
+        return [None] * len(ids)
+    setting = {
+        "model": getattr(w, "snapshot_dir", None) or w.branch,
+        "precision": w.precision,
+        "adapter": getattr(w, "active_adapter", None) or "default",
+        "params": {k: repr(v) for k, v in params.items() if k != "assistant_model"},
+        "single_pass": single_pass,
+        "stopping": [STOP_ON_SPECIALS, STOP_NEWLINE, STOP_MAX_SENTENCES] if stopping else None,
+    }
+    return [response_cache.key({"ids": row, **setting}) for row in ids]
+
+def _run_batch(prompts, gen_params, single_pass, stopping):
+    ids, reports = _encode_ids(prompts)
+    params = {**GEN_PARAMS, **(gen_params or {})}
+    keys = _response_keys(ids, params, single_pass, stopping)
+
+    results = [response_cache.get(key) if key else None for key in keys]
+    for result in results:
+        if result is not None:
+            result["cached"] = True
+            # nothing was run for this request: the stored timing belongs to the original one
+            result["timing"] = {
+                "prefill_ms": 0.0,
+                "decode_ms": 0.0,
+                "new_tokens": result.get("timing", {}).get("new_tokens", 0),
+                "batch_size": len(ids),
+            }
+    todo = [i for i, result in enumerate(results) if result is None]
+    if todo:
+        generated = _generate_batch([ids[i] for i in todo], params, single_pass, stopping)
+        for i, result in zip(todo, generated):
+            results[i] = result
+            if keys[i] is not None:
+                with _swap_lock:
+                    if _engine() is wrapper:  # not a request finishing on a swapped-out model
+                        response_cache.put(keys[i], result)
+    return _attach_trim(results, reports)
+
+def _generate_batch(ids, params, single_pass, stopping):
+    tokenizer = _engine().tokenizer
+    inputs = _pad(ids)
+    prompt_len = inputs["input_ids"].shape[1]
+    params = _seeded(_with_draft(dict(params), len(ids)))
+    stopper = DialogueStopper(tokenizer, prompt_len, len(ids)) if stopping else None
+    if stopper is not None:
+        params["stopping_criteria"] = StoppingCriteriaList([stopper])
+
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        # single prompts reuse the cached KV of their header and prefill only <CTX>...<NPC>
+        past = _prefix_past(inputs["input_ids"]) if len(ids) == 1 else None
+
+        # language generation + hidden state of the prompt
+        with _first_pass_time(_final_norm(_engine().model)) as mark:
+            gen_ids, pooled = _generate_with_state(inputs, params, single_pass=single_pass, past=past)
+        t1 = time.perf_counter()
+        new_ids = gen_ids[:, prompt_len:]
+        generated_texts = tokenizer.batch_decode(new_ids, skip_special_tokens=True)
+        results = _format_results(generated_texts, pooled)
+
+    eos_ids = _eos_ids()
+    # prefill = header lookup + first pass, decode = the rest (per batch)
+    prefill_end = mark.get("t", t1)
+    finished = eos_ids | {tokenizer.pad_token_id}
+    for i, result in enumerate(results):
+        row = new_ids[i].tolist()
+        result["timing"] = {
+            "prefill_ms": round((prefill_end - t0) * 1000, 2),
+            "decode_ms": round((t1 - prefill_end) * 1000, 2),
+            "new_tokens": next((k + 1 for k, t in enumerate(row) if t in finished), len(row)),
+            "batch_size": len(ids),
+        }
+    if stopper is not None:
+        for i, result in enumerate(results):
+            result["npc_output_text"] = stopper.trim(result["npc_output_text"]).strip()
+            result["stop_reason"] = stopper.finish_reason(i, new_ids[i], eos_ids)
+    return results
+
+def run_inference(prompt: str, gen_params: dict = None, single_pass: bool = SINGLE_PASS_HEADS,
+                  stopping: bool = True, adapter: str = None):
+    return run_inference_batch(
+        [prompt], gen_params=gen_params, single_pass=single_pass, stopping=stopping, adapters=adapter
+    )[0]
 
-        # <STATE> token position pooling
-        STATE_ID = tokenizer.convert_tokens_to_ids("<STATE>")
-        ids = inputs["input_ids"]
-        mask = (ids == STATE_ID).unsqueeze(-1)
-        if mask.any():
-            counts = mask.sum(dim=1).clamp_min(1)
-            pooled = (h * mask).sum(dim=1) / counts
-        else:
-            pooled = h[:, -1, :]
+class _EventStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that can also carry non-text events (dicts) in order."""
 
-        # delta, flag, flag_threshold prediction
-        delta_pred = torch.tanh(model.delta_head(pooled))[0].cpu().tolist()
-        flag_prob = torch.sigmoid(model.flag_head(pooled))[0].cpu().tolist()
-        flag_thr = torch.sigmoid(model.flag_threshold_head(pooled))[0].cpu().tolist()
+    def put_event(self, event: dict):
+        self.text_queue.put(event, timeout=self.timeout)
 
-    flags_prob_dict = {name: round(prob, 6) for name, prob in zip(flags_order, flag_prob)}
-    flags_thr_dict = {name: round(thr, 6) for name, thr in zip(flags_order, flag_thr)}
+def stream_inference(prompt: str, gen_params: dict = None, stopping: bool = True, adapter: str = None):
+    """
+    Streaming variant of run_inference(). generate() runs in a worker thread and this
+    generator yields events in order:
+      {"event": "state", "deltas": ..., "flags_prob": ..., "flags_thr": ...}  # right after the prefill
+      {"event": "text", "text": chunk}                                       # as tokens are decoded
+      {"event": "done", "npc_output_text": ..., "stop_reason": ...}
+    The heads depend only on the prompt, so the state event arrives within the
+    first-token latency. `adapter` stays active until the stream is finished.
+    """
+    w = _engine()
+    with _pinned(w):  # counts the whole stream in flight; re-pinned in the worker thread
+        tokenizer, model, _ = w.get()
+        inputs, reports = _encode([prompt])
+        prompt_len = inputs["input_ids"].shape[1]
+        params = _seeded(_with_draft({**GEN_PARAMS, **(gen_params or {})}, 1))
+        stopper = DialogueStopper(tokenizer, prompt_len, 1) if stopping else None
+        if stopper is not None:
+            params["stopping_criteria"] = StoppingCriteriaList([stopper])
+        streamer = _EventStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        params["streamer"] = streamer
+        norm = _final_norm(model)
+        outcome = {}
 
+    def _worker():
+        try:
+            # the adapter (and the prefix KV it computes) is held by the generating thread
+            with _pinned(w), w.use_adapter(adapter), torch.no_grad():
+                past = _prefix_past(inputs["input_ids"])
+                start, cache = past if past is not None else (0, None)
+
+                def _emit_state(h):
+                    pooled = _pool_state(h, inputs["input_ids"][:, start:])
+                    streamer.put_event({"event": "state", **_format_states(pooled)[0]})
+
+                if norm is not None:
+                    with _capture_prefill_hidden(norm, on_prefill=_emit_state):
+                        outcome["gen_ids"] = _generate(inputs, params, cache)
+                else:
+                    # no hookable norm: separate prefill for the heads (on a copy of the cache)
+                    second = (start, copy.deepcopy(cache)) if cache is not None else None
+                    pooled = _prefill_state(inputs, past=second)
+                    streamer.put_event({"event": "state", **_format_states(pooled)[0]})
+                    outcome["gen_ids"] = _generate(inputs, params, cache)
+        except Exception as e:
+            outcome["error"] = e
+            streamer.end()
+
+    thread = Thread(target=_worker, daemon=True)
+    thread.start()
+    chunks = []
+    for item in streamer:
+        if isinstance(item, dict):
+            yield item
+        elif item:
+            chunks.append(item)
+            yield {"event": "text", "text": item}
+    thread.join()
+    if "error" in outcome:
+        raise outcome["error"]
+
+    text = "".join(chunks).strip()
+    done = {"event": "done", "npc_output_text": text}
+    if stopper is not None:
+        with _pinned(w):
+            eos_ids = _eos_ids()
+        done["npc_output_text"] = stopper.trim(text).strip()
+        done["stop_reason"] = stopper.finish_reason(0, outcome["gen_ids"][0, prompt_len:], eos_ids)
+    yield _attach_trim([done], reports)[0]
+
+def cache_stats():
+    return {"prefix_cache": prefix_cache.stats(), "response_cache": response_cache.stats()}
+
+# ----------------------------
+# Static-shape compiled decode
+# ----------------------------
+
+def _disable_static(w):
+    w.static_decode = False
+    eager = getattr(w, "eager_forward", None)
+    if eager is not None:
+        w.model.forward = eager
+    getattr(w, "static_caches", {}).clear()
+
+def _setup_static(w):
+    """
+    Compile the decode step of `w` (one token against a StaticCache; the prefill stays eager)
+    and warm it up with a dummy request per batch size up to BATCH_MAX_SIZE (the graph is
+    specialised on the StaticCache shape), so the compile time is paid at load rather than
+    by the first request of each batch size. The warm-up keeps only the caches that fit in
+    STATIC_CACHE_MAX_MB (the graphs stay compiled). Any failure leaves `w` on the dynamic-cache path.
+    """
+    w.static_decode = False
+    if not STATIC_DECODE:
+        return
+    if hasattr(w, "register_adapter"):
+        # set_adapter() swaps modules under the compiled graph
+        print("[WARN] STATIC_DECODE is not supported with LORA_ADAPTERS, using the dynamic cache")
+        return
+
+    model = w.model
+    w.eager_forward = eager = model.forward
+    w.static_caches = OrderedDict()  # batch size -> (StaticCache, MB)
+    w.static_lock = threading.RLock()
+    t0 = time.perf_counter()
+    try:
+        dynamo = torch._dynamo.config
+        dynamo.cache_size_limit = max(dynamo.cache_size_limit, 2 * BATCH_MAX_SIZE)  # one graph per batch size
+        compiled = torch.compile(eager, dynamic=False, mode="reduce-overhead" if DEVICE.startswith("cuda") else None)
+
+        def forward(*args, **kwargs):
+            ids = kwargs.get("input_ids")
+            if ids is not None and ids.shape[1] == 1 and isinstance(kwargs.get("past_key_values"), StaticCache):
+                return compiled(*args, **kwargs)
+            return eager(*args, **kwargs)
+
+        model.forward = forward
+        model.generation_config.disable_compile = True  # generate() must not compile it a second time
+        w.static_decode = True
+        # greedy, straight through _generate_batch (never the response cache), no draft model
+        params = {**GEN_PARAMS, "max_new_tokens": 4, "min_new_tokens": 4, "do_sample": False,
+                  "temperature": None, "top_p": None, "assistant_model": None}
+        with _pinned(w):
+            ids, _ = _encode_ids([_assemble_prompt_for_model({"npc_id": "warmup", "player_utterance": "..."})])
+            for batch_size in range(1, max(1, BATCH_MAX_SIZE) + 1):
+                if not w.static_decode:  # a warm-up run fell back to the dynamic cache
+                    break
+                _generate_batch(ids * batch_size, params, SINGLE_PASS_HEADS, stopping=False)
+        if w.static_decode:
+            print(f"[startup] static decode compile + warm-up {time.perf_counter() - t0:.2f}s")
+    except Exception as e:
+        print(f"[WARN] torch.compile of the decode step failed, using the dynamic cache: {e}")
+        _disable_static(w)
+
+def adapter_stats():
+    """
+    Loaded adapters: memory of their LoRA weights / heads (MB), load time and how
+    often (and how long in total) activating each one took.
+    """
+    w = wrapper
     return {
-        "npc_output_text": generated_text.strip(),
-        "deltas": {
-            "trust": float(delta_pred[0]),
-            "relationship": float(delta_pred[1]),
-        },
-        "flags_prob": flags_prob_dict,
-        "flags_thr": flags_thr_dict,
+        "active": getattr(w, "active_adapter", None) or "default",
+        "adapters": {name: dict(s) for name, s in getattr(w, "adapter_stats", {}).items()},
     }
 
-def reload_model(branch="latest"):
+def add_adapter(name: str, spec: str):
+    """Load one more adapter ("repo[/subfolder][@revision]") without reloading the base model."""
+    if not hasattr(wrapper, "register_adapter"):
+        raise RuntimeError("Adding adapters needs LORA_ADAPTERS (base model + unmerged adapters)")
+    wrapper.register_adapter(name, parse_adapter_specs(f"{name}={spec}")[name])
+    return adapter_stats()
+
+# ----------------------------
+# Hot-swap (reload_model)
+# ----------------------------
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _inflight_count(w) -> int:
+    with _inflight_lock:
+        return _inflight.get(id(w), 0)
+
+def _shadow_load(branch: str):
     global wrapper, tokenizer, model, flags_order
-    wrapper = ModelWrapper(branch=branch)
-    tokenizer, model, flags_order = wrapper.get()
-    print(f"Model reloaded from branch: {branch}")
+    try:
+        t0 = time.perf_counter()
+        new = build_wrapper(branch=branch)
+        _setup_static(new)
+        loaded = time.perf_counter()
+        _reload.update(state="warming", load_seconds=round(loaded - t0, 2), rss_overlap_mb=round(_rss_mb(), 1))
+
+        # one dummy inference so the first real request doesn't pay for lazy init
+        with _pinned(new):
+            run_inference(
+                _assemble_prompt_for_model({"npc_id": "warmup", "player_utterance": "..."}),
+                gen_params={"max_new_tokens": 1},
+            )
+        _reload.update(state="swapping", warmup_seconds=round(time.perf_counter() - loaded, 2))
+
+        with _swap_lock:
+            old = wrapper
+            wrapper = new
+            tokenizer, model, flags_order = new.get()
+            prefix_cache.clear()  # cached KV belongs to the old weights
+            response_cache.clear()
+        _reload.update(state="draining", branch=branch, swapped_at=time.time())
+        set_current_branch(branch)
+
+        # in-flight requests finish on the old model; release it once they are done
+        while _inflight_count(old):
+            time.sleep(0.05)
+        del old
+        gc.collect()
+        _reload.update(
+            state="idle",
+            overlap_seconds=round(time.perf_counter() - loaded, 2),
+            rss_after_mb=round(_rss_mb(), 1),
+        )
+        print(f"Model reloaded from branch: {branch}")
+    except Exception as e:
+        _reload.update(state="failed", error=str(e))
+        print(f"[WARN] Reload of branch {branch} failed, keeping {wrapper.branch}: {e}")
+
+def reload_model(branch="latest", wait: bool = False):
+    """
+    Zero-downtime reload: `branch` (and its head weights) is loaded in a background thread
+    while the current model keeps serving, warmed with one dummy inference, then swapped in
+    under a lock. Requests already running finish on the old model.
+    Returns reload_status(); wait=True blocks until the swap is done.
+    With a pinned MODEL_SNAPSHOT_DIR (no MODEL_SNAPSHOT_DIR/<branch>) only the current
+    branch can be reloaded: other branches are rejected instead of reloading the same weights.
+    """
+    with _swap_lock:
+        if _reload["state"] in ("loading", "warming", "swapping", "draining"):
+            return reload_status()
+        if branch != wrapper.branch and fixed_snapshot(branch):
+            _reload.update(
+                state="rejected", target_branch=branch,
+                error=f"MODEL_SNAPSHOT_DIR pins one checkpoint and has no '{branch}' subdirectory",
+            )
+            return reload_status()
+        _reload.clear()
+        _reload.update(
+            state="loading",
+            branch=wrapper.branch,
+            target_branch=branch,
+            started_at=time.time(),
+            rss_before_mb=round(_rss_mb(), 1),
+        )
+    thread = Thread(target=_shadow_load, args=(branch,), daemon=True, name="neural-reload")
+    thread.start()
+    if wait:
+        thread.join()
+    return reload_status()
+
+def reload_status():
+    """Reload progress, timings (load/warm-up/overlap seconds) and RSS around the swap."""
+    status = dict(_reload)
+    status["active_branch"] = wrapper.branch
+    status["inflight"] = _inflight_count(wrapper)
+    status["rss_mb"] = round(_rss_mb(), 1)
+    return status
+
+_setup_static(wrapper)
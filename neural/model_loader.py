@@ -1,77 +1,430 @@
+import hashlib
 import json
 import os
+import threading
+import time
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
-from config import DEVICE, HF_TOKEN
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from config import (BASE_MODEL, DEVICE, GEN_MAX_NEW_TOKENS, HF_TOKEN,
+                    LORA_ADAPTERS, MAX_LENGTH, MODEL_SNAPSHOT_DIR, PRECISION,
+                    TINY_MODEL, TOKENIZER_CACHE_DIR)
+from huggingface_hub import hf_hub_download, snapshot_download
+from transformers import (AutoConfig, AutoModelForCausalLM, AutoTokenizer,
+                          PreTrainedTokenizerFast)
 
 SPECIALS = ["<SYS>", "<CTX>", "<PLAYER>", "<NPC>", "<STATE>", "<RAG>", "<PLAYER_STATE>"]
 
+# precision mode -> dtype the base weights are loaded in ("int8" quantizes the fp32 weights afterwards)
+LOAD_DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "int8": torch.float32}
+
 def get_current_branch():
     if os.path.exists("current_branch.txt"):
         with open("current_branch.txt", "r") as f:
             return f.read().strip()
     return "latest"
 
+def set_current_branch(branch: str):
+    with open("current_branch.txt", "w") as f:
+        f.write(branch)
+
+HEAD_FILES = [
+    ("delta_head", "delta_head.pt"),
+    ("flag_head", "flag_head.pt"),
+    ("flag_threshold_head", "flag_threshold_head.pt")
+]
+
+def _head_weights_path(file_name: str, branch: str = None, repo: str = "m97j/npc_LoRA-fps",
+                       subfolder: str = "testcase_output", local_fallback: bool = True, local_dir: str = None):
+    """Head weights from `local_dir` (a snapshot) or of `branch` from the Hub, falling back to a local file."""
+    if local_dir is not None:
+        path = os.path.join(local_dir, file_name)
+        if os.path.exists(path):
+            return path
+        return file_name if local_fallback and os.path.exists(file_name) else None
+    try:
+        return hf_hub_download(
+            repo,
+            file_name,
+            subfolder=subfolder,
+            revision=branch,
+            token=HF_TOKEN
+        )
+    except Exception:
+        if local_fallback and os.path.exists(file_name):
+            return file_name
+        return None
+
+def _new_heads(hidden_size: int, num_flags: int) -> dict:
+    # custom heads (delta, flag, flag_threshold), always fp32 whatever the base precision
+    return {
+        "delta_head": nn.Linear(hidden_size, 2).to(DEVICE),
+        "flag_head": nn.Linear(hidden_size, num_flags).to(DEVICE),
+        "flag_threshold_head": nn.Linear(hidden_size, num_flags).to(DEVICE),
+    }
+
+def _load_head_weights(heads: dict, **location):
+    """Load the trained weights of every head in `heads` (see _head_weights_path for `location`)."""
+    for head_name, file_name in HEAD_FILES:
+        try:
+            path = _head_weights_path(file_name, **location)
+            if path:
+                heads[head_name].load_state_dict(torch.load(path, map_location=DEVICE))
+        except Exception as e:
+            print(f"[WARN] Failed to load {file_name}: {e}")
+
+def fixed_snapshot(branch: str) -> bool:
+    """True if MODEL_SNAPSHOT_DIR pins one checkpoint that has no per-branch MODEL_SNAPSHOT_DIR/<branch>."""
+    return bool(MODEL_SNAPSHOT_DIR) and not os.path.isdir(os.path.join(MODEL_SNAPSHOT_DIR, branch))
+
+def resolve_snapshot(branch: str) -> str:
+    """
+    Local directory of the merged checkpoint: MODEL_SNAPSHOT_DIR/<branch> if it exists, else
+    MODEL_SNAPSHOT_DIR itself if set (one pinned checkpoint, see fixed_snapshot), else the
+    snapshot of `branch` (downloaded once into the HF cache; later starts only resolve the revision).
+    """
+    if MODEL_SNAPSHOT_DIR:
+        return MODEL_SNAPSHOT_DIR if fixed_snapshot(branch) else os.path.join(MODEL_SNAPSHOT_DIR, branch)
+    root = snapshot_download(
+        "m97j/npc_LoRA-fps",
+        revision=branch,
+        allow_patterns=["testcase_output/*"],
+        token=HF_TOKEN
+    )
+    return os.path.join(root, "testcase_output")
+
+def load_tokenizer(snapshot_dir: str):
+    """
+    Tokenizer of a snapshot with pad token, left padding and SPECIALS; the result is saved
+    under TOKENIZER_CACHE_DIR (keyed by the snapshot path, i.e. its commit) and reused.
+    """
+    key = hashlib.sha1(os.path.realpath(snapshot_dir).encode("utf-8")).hexdigest()[:16]
+    cache_dir = os.path.join(TOKENIZER_CACHE_DIR, key)
+    if os.path.isfile(os.path.join(cache_dir, "tokenizer_config.json")):
+        tokenizer = AutoTokenizer.from_pretrained(cache_dir, use_fast=True, trust_remote_code=True)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(snapshot_dir, use_fast=True, trust_remote_code=True)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.add_special_tokens({"additional_special_tokens": SPECIALS})
+        try:
+            tokenizer.save_pretrained(cache_dir)
+        except OSError as e:
+            print(f"[WARN] Failed to cache tokenizer in {cache_dir}: {e}")
+    # left padding so batched generate() continues every row from its last prompt token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
 class ModelWrapper:
-    def __init__(self):
+    def __init__(self, branch=None, precision=PRECISION):
+        if precision not in LOAD_DTYPES:
+            raise ValueError(f"Unknown PRECISION '{precision}', expected one of {list(LOAD_DTYPES)}")
+        if precision == "int8" and DEVICE != "cpu":
+            print(f"[WARN] int8 dynamic quantization is CPU only, using fp32 on {DEVICE}")
+            precision = "fp32"
+        self.precision = precision
+
         # Flags info
         flags_path = os.path.join(os.path.dirname(__file__), "flags.json")
         self.flags_order = json.load(open(flags_path, encoding="utf-8"))["ALL_FLAGS"]
         self.num_flags = len(self.flags_order)
 
-        branch = get_current_branch()
+        branch = branch or get_current_branch()
+        self.branch = branch
+        self.startup = {}  # phase -> seconds
+        t0 = phase = time.perf_counter()
+
+        def _done(name):
+            nonlocal phase
+            now = time.perf_counter()
+            self.startup[name] = round(now - phase, 3)
+            phase = now
+
+        # 0) Local snapshot of the branch (all files below are read from disk)
+        self.snapshot_dir = resolve_snapshot(branch)
+        _done("snapshot")
 
         # 1) Tokenizer (vocab + SPECIALS at the time of training LoRA)
+        self.tokenizer = load_tokenizer(self.snapshot_dir)
+        _done("tokenizer")
+
+        # 2) Base model (LoRA model with merged weights, but without custom heads)
+        #  - low_cpu_mem_usage: no random init, safetensors are mmapped and loaded straight onto the device
+        self.model = AutoModelForCausalLM.from_pretrained(
+            self.snapshot_dir,
+            device_map={"": DEVICE} if DEVICE != "cpu" else None,
+            low_cpu_mem_usage=True,
+            torch_dtype=LOAD_DTYPES[precision],
+            trust_remote_code=True
+        )
+        _done("model")
+        if precision == "int8":
+            # quantize before the heads are attached so they stay fp32
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+            _done("quantize")
+
+        # 3) add custom heads (delta, flag, flag_threshold) - architecture only, weights will be loaded separately
+        heads = _new_heads(self.model.config.hidden_size, self.num_flags)
+        for head_name, head in heads.items():
+            setattr(self.model, head_name, head)
+
+        # 4) Load custom head weights separately (if available)
+        #  - this is necessary because the LoRA merging process may not include these heads, and they might be trained separately.
+        _load_head_weights(heads, local_dir=self.snapshot_dir)
+
+        # 5) eval mode (everything is already on DEVICE)
+        self.model.eval()
+        _done("heads")
+
+        self.startup["total"] = round(time.perf_counter() - t0, 3)
+        print("[startup] " + " | ".join(f"{name} {sec:.2f}s" for name, sec in self.startup.items()))
+
+    def get(self):
+        return self.tokenizer, self.model, self.flags_order
+
+    @property
+    def adapters(self):
+        return ["default"]
+
+    @contextmanager
+    def use_adapter(self, name=None):
+        # merged checkpoint: the single built-in adapter
+        if name not in (None, "default"):
+            raise KeyError(f"Unknown adapter '{name}' (LORA_ADAPTERS is not set)")
+        yield "default"
+
+
+def _tiny_tokenizer():
+    """Byte-level BPE trained on test_cases.json (deterministic, offline) + SPECIALS."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    cases_path = os.path.join(os.path.dirname(__file__), "test_cases.json")
+    with open(cases_path, encoding="utf-8") as f:
+        corpus = [json.dumps(case, ensure_ascii=False) for case in json.load(f)]
+
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=2048, special_tokens=["<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, eos_token="<|endoftext|>", pad_token="<|endoftext|>")
+    tokenizer.add_special_tokens({"additional_special_tokens": SPECIALS})
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+
+class TinyModelWrapper(ModelWrapper):
+    """
+    Randomly initialized (seeded) model of the base architecture at toy size, with a locally
+    trained tokenizer: exercises the whole inference path without Hub access.
+    """
+
+    def __init__(self, branch=None, precision="fp32", seed=0):
+        torch.manual_seed(seed)
+        self.precision = "fp32"
+        self.branch = "tiny"
+        flags_path = os.path.join(os.path.dirname(__file__), "flags.json")
+        self.flags_order = json.load(open(flags_path, encoding="utf-8"))["ALL_FLAGS"]
+        self.num_flags = len(self.flags_order)
+
+        t0 = time.perf_counter()
+        self.tokenizer = _tiny_tokenizer()
+        config = AutoConfig.for_model(
+            "qwen2",
+            vocab_size=len(self.tokenizer),
+            hidden_size=64,
+            intermediate_size=128,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            max_position_embeddings=MAX_LENGTH + GEN_MAX_NEW_TOKENS,
+            tie_word_embeddings=True,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
+        self.model = AutoModelForCausalLM.from_config(config)
+        for head_name, head in _new_heads(config.hidden_size, self.num_flags).items():
+            setattr(self.model, head_name, head)
+        self.model.to(DEVICE)
+        self.model.eval()
+        self.startup = {"total": round(time.perf_counter() - t0, 3)}
+
+
+def parse_adapter_specs(spec: str) -> dict:
+    """
+    "name=repo[/subfolder][@revision],..." -> {name: {"repo", "subfolder", "revision"}}
+    e.g. "blacksmith=m97j/npc_LoRA-fps/testcase_output@latest,guard=org/guard-lora"
+    """
+    adapters = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, path = item.partition("=")
+        if not path:
+            raise ValueError(f"Bad LORA_ADAPTERS entry '{item}', expected name=repo[/subfolder][@revision]")
+        path, _, revision = path.partition("@")
+        parts = path.strip("/").split("/")
+        adapters[name.strip()] = {
+            "repo": "/".join(parts[:2]),
+            "subfolder": "/".join(parts[2:]) or None,
+            "revision": revision or None,
+        }
+    return adapters
+
+
+class MultiAdapterWrapper:
+    """
+    BASE_MODEL loaded once with several unmerged LoRA adapters, each with its own
+    delta/flag heads. Requests choose one with `use_adapter(name)`, which activates
+    it (set_adapter + head swap) and holds it until the block exits.
+    """
+
+    def __init__(self, adapters: dict, branch=None, precision=PRECISION, base_model=BASE_MODEL):
+        if not adapters:
+            raise ValueError("MultiAdapterWrapper needs at least one adapter")
+        if precision not in LOAD_DTYPES:
+            raise ValueError(f"Unknown PRECISION '{precision}', expected one of {list(LOAD_DTYPES)}")
+        if precision == "int8":
+            # dynamic quantization replaces the Linear layers the LoRA weights are injected into
+            print("[WARN] int8 is not supported with LORA_ADAPTERS, using fp32")
+            precision = "fp32"
+        self.precision = precision
+        self.branch = branch or "main"  # revision of adapters without an explicit @revision
+
+        flags_path = os.path.join(os.path.dirname(__file__), "flags.json")
+        self.flags_order = json.load(open(flags_path, encoding="utf-8"))["ALL_FLAGS"]
+        self.num_flags = len(self.flags_order)
+
+        # 1) Tokenizer of the first adapter (vocab + SPECIALS); all adapters share it
+        first = next(iter(adapters.values()))
         self.tokenizer = AutoTokenizer.from_pretrained(
-            "m97j/npc_LoRA-fps",
-            revision=branch,
-            subfolder="testcase_output",
+            first["repo"],
+            revision=first["revision"] or self.branch,
+            subfolder=first["subfolder"] or "",
             use_fast=True,
             token=HF_TOKEN,
             trust_remote_code=True
         )
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.tokenizer.padding_side = "right"
+        self.tokenizer.padding_side = "left"
         self.tokenizer.add_special_tokens({"additional_special_tokens": SPECIALS})
 
-        # 2) Base model (LoRA model with merged weights, but without custom heads)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            "m97j/npc_LoRA-fps",
-            revision=branch,
-            subfolder="testcase_output",
-            device_map=None,
-            low_cpu_mem_usage=False,
+        # 2) Base model, once
+        self._base = AutoModelForCausalLM.from_pretrained(
+            base_model,
+            low_cpu_mem_usage=True,
+            torch_dtype=LOAD_DTYPES[precision],
             trust_remote_code=True,
             token=HF_TOKEN
         )
+        if self._base.get_input_embeddings().num_embeddings < len(self.tokenizer):
+            self._base.resize_token_embeddings(len(self.tokenizer))
 
-        # 3) add custom heads (delta, flag, flag_threshold) - architecture only, weights will be loaded separately
-        hidden_size = self.model.config.hidden_size
-        self.model.delta_head = nn.Linear(hidden_size, 2).to(DEVICE)
-        self.model.flag_head = nn.Linear(hidden_size, self.num_flags).to(DEVICE)
-        self.model.flag_threshold_head = nn.Linear(hidden_size, self.num_flags).to(DEVICE)
+        # 3) Adapters (unmerged) + their heads
+        self.model = None
+        self.heads = {}
+        self.adapter_stats = {}
+        self._lock = threading.RLock()
+        self.active_adapter = None
+        self.default_adapter = next(iter(adapters))
+        for name, spec in adapters.items():
+            self.register_adapter(name, spec)
+        with self.use_adapter(self.default_adapter):
+            pass
 
-        # 4) Load custom head weights separately (if available)
-        #  - this is necessary because the LoRA merging process may not include these heads, and they might be trained separately.
-        for head_name, file_name in [
-            ("delta_head", "delta_head.pt"),
-            ("flag_head", "flag_head.pt"),
-            ("flag_threshold_head", "flag_threshold_head.pt")
-        ]:
-            try:
-                if os.path.exists(file_name):
-                    getattr(self.model, head_name).load_state_dict(
-                        torch.load(file_name, map_location=DEVICE)
-                    )
-            except Exception as e:
-                print(f"[WARN] Failed to load {file_name}: {e}")
-
-        # 5) Move model to device and set to eval mode
-        self.model.to(DEVICE)
-        self.model.eval()
+    def register_adapter(self, name: str, spec: dict):
+        """Load one more adapter (and its heads) onto the shared base model."""
+        from peft import PeftModel
+
+        t0 = time.perf_counter()
+        revision = spec.get("revision") or self.branch
+        location = {"subfolder": spec.get("subfolder") or "", "revision": revision, "token": HF_TOKEN}
+        with self._lock:
+            if name in self.heads:
+                raise ValueError(f"Adapter '{name}' is already loaded")
+            if self.model is None:
+                self.model = PeftModel.from_pretrained(self._base, spec["repo"], adapter_name=name, **location)
+            else:
+                self.model.load_adapter(spec["repo"], adapter_name=name, **location)
+            self.model.to(DEVICE)
+            self.model.eval()
+
+            heads = _new_heads(self._base.config.hidden_size, self.num_flags)
+            _load_head_weights(
+                heads, branch=revision, repo=spec["repo"], subfolder=spec.get("subfolder"), local_fallback=False
+            )
+            self.heads[name] = heads
+
+        self.adapter_stats[name] = {
+            **spec,
+            "load_seconds": round(time.perf_counter() - t0, 3),
+            "adapter_mb": round(self._adapter_bytes(name) / 2**20, 2),
+            "heads_mb": round(sum(p.numel() * p.element_size() for h in heads.values() for p in h.parameters()) / 2**20, 2),
+            "switches": 0,
+            "switch_seconds": 0.0,
+        }
+
+    def _adapter_bytes(self, name: str) -> int:
+        # LoRA parameters are registered as "...lora_A.<name>.weight" etc.
+        tag = f".{name}."
+        return sum(p.numel() * p.element_size() for n, p in self.model.named_parameters() if tag in n)
 
     def get(self):
         return self.tokenizer, self.model, self.flags_order
+
+    @property
+    def adapters(self):
+        return list(self.heads)
+
+    @contextmanager
+    def use_adapter(self, name=None):
+        """Activate adapter `name` (None = the first one) for the duration of the block."""
+        name = name or self.default_adapter
+        if name not in self.heads:
+            raise KeyError(f"Unknown adapter '{name}', loaded: {self.adapters}")
+        with self._lock:
+            if name != self.active_adapter:
+                t0 = time.perf_counter()
+                self.model.set_adapter(name)
+                for head_name, head in self.heads[name].items():
+                    setattr(self.model, head_name, head)
+                self.active_adapter = name
+                stats = self.adapter_stats[name]
+                stats["switches"] += 1
+                stats["switch_seconds"] += time.perf_counter() - t0
+            yield name
+
+
+def build_wrapper(branch=None):
+    """
+    TinyModelWrapper if TINY_MODEL is set, MultiAdapterWrapper if LORA_ADAPTERS is set,
+    else the merged-checkpoint ModelWrapper.
+    """
+    if TINY_MODEL:
+        return TinyModelWrapper(branch=branch)
+    if LORA_ADAPTERS:
+        return MultiAdapterWrapper(parse_adapter_specs(LORA_ADAPTERS), branch=branch)
+    return ModelWrapper(branch=branch)
+
+
+def load_draft_model(name: str, tokenizer, num_assistant_tokens: int):
+    """
+    Small draft model for assisted generation. It must share the tokenizer vocab;
+    its embeddings are resized if the SPECIALS ids fall outside them.
+    """
+    draft = AutoModelForCausalLM.from_pretrained(
+        name,
+        low_cpu_mem_usage=True,
+        torch_dtype=LOAD_DTYPES["bf16" if PRECISION == "bf16" else "fp32"],
+        trust_remote_code=True,
+        token=HF_TOKEN
+    )
+    if draft.get_input_embeddings().num_embeddings < len(tokenizer):
+        draft.resize_token_embeddings(len(tokenizer))
+    draft.generation_config.num_assistant_tokens = num_assistant_tokens
+    draft.to(DEVICE)
+    draft.eval()
+    return draft
@@ -1,7 +1,7 @@
 import json
 import os
 
-from inference import run_inference
+from inference import run_inference, stream_inference
 from webtest_prompt import build_webtest_prompt
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
@@ -26,3 +26,18 @@ def run_case(idx, player_utt):
     prompt = build_webtest_prompt(case["npc_id"], case["npc_location"], player_utt)
     result = run_inference(prompt)
     return result["npc_output_text"], result["deltas"], result["flags_prob"]
+
+def stream_case(idx, player_utt):
+    """Streaming run_case: deltas/flags first, then the NPC text as it is generated."""
+    case = TEST_CASES[idx]["input"].copy()
+    case["player_utterance"] = player_utt
+    prompt = build_webtest_prompt(case["npc_id"], case["npc_location"], player_utt)
+    text, deltas, flags = "", {}, {}
+    for event in stream_inference(prompt):
+        if event["event"] == "state":
+            deltas, flags = event["deltas"], event["flags_prob"]
+        elif event["event"] == "text":
+            text += event["text"]
+        else:
+            text = event["npc_output_text"]
+        yield text, deltas, flags
@@ -1,6 +1,6 @@
 import gradio as gr
 
-from modules.case_loader import load_case, run_case
+from modules.case_loader import load_case, stream_case
 
 # test case names (for dropdown display)
 CASE_NAMES = [
@@ -102,9 +102,12 @@ def build_ui():
             ]
         )
 
-        # execute inference
+        # execute inference (streamed: deltas/flags first, then the NPC text)
+        def on_run_case(name, utt):
+            yield from stream_case(CASE_NAMES.index(name), utt)
+
         run_btn.click(
-            fn=lambda name, utt: run_case(CASE_NAMES.index(name), utt),
+            fn=on_run_case,
             inputs=[case_dropdown, player_input],
             outputs=[npc_resp, deltas, flags]
         )
@@ -0,0 +1,79 @@
+"""
+Precision report: RSS, tokens/sec and delta/flag drift of bf16 / int8 against fp32
+on test_cases.json. Every mode runs in its own process (PRECISION=<mode>) so the
+memory numbers are not mixed.
+
+    python precision_report.py --modes fp32,bf16,int8
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def worker(max_new_tokens: int):
+    import inference
+    from modules.case_loader import load_cases
+    from webtest_prompt import _assemble_prompt_for_model
+
+    params = {"do_sample": False, "temperature": None, "top_p": None, "max_new_tokens": max_new_tokens}
+    states, tokens, elapsed = [], 0, 0.0
+    for case in load_cases():
+        prompt = _assemble_prompt_for_model(case["input"])
+        t0 = time.perf_counter()
+        result = inference.run_inference(prompt, gen_params=params, stopping=False)
+        elapsed += time.perf_counter() - t0
+        tokens += len(inference.tokenizer(result["npc_output_text"])["input_ids"])
+        states.append(inference.predict_state(prompt))
+
+    print(json.dumps({
+        "precision": inference.wrapper.precision,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "tokens_per_sec": tokens / elapsed if elapsed else 0.0,
+        "states": states,
+    }))
+
+
+def _drift(ref_states, states):
+    """Max absolute difference of deltas / flag probs / flag thresholds vs the reference."""
+    out = {"deltas": 0.0, "flags_prob": 0.0, "flags_thr": 0.0}
+    for ref, cur in zip(ref_states, states):
+        for key in out:
+            for name, value in ref[key].items():
+                out[key] = max(out[key], abs(value - cur[key][name]))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="fp32,bf16,int8")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.max_new_tokens)
+        return
+
+    reports = {}
+    for mode in args.modes.split(","):
+        env = {**os.environ, "PRECISION": mode}
+        out = subprocess.run(
+            [sys.executable, __file__, "--worker", "--max-new-tokens", str(args.max_new_tokens)],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+        ).stdout
+        reports[mode] = json.loads(out.strip().splitlines()[-1])
+
+    ref = reports.get("fp32")
+    print(f"{'mode':6s} {'peak RSS':>10s} {'tok/s':>8s}  drift vs fp32 (max abs: deltas / flags_prob / flags_thr)")
+    for mode, r in reports.items():
+        drift = _drift(ref["states"], r["states"]) if ref else None
+        drift_txt = " / ".join(f"{v:.4f}" for v in drift.values()) if drift else "-"
+        print(f"{mode:6s} {r['peak_rss_mb']:8.0f}MB {r['tokens_per_sec']:8.2f}  {drift_txt}")
+
+
+if __name__ == "__main__":
+    main()
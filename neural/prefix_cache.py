@@ -0,0 +1,90 @@
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def _nbytes(obj) -> int:
+    """Approximate memory of a past_key_values object (DynamicCache or legacy tuples)."""
+    if torch.is_tensor(obj):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(o) for o in obj)
+    if hasattr(obj, "layers"):  # transformers >= 4.56 cache layers
+        return sum(_nbytes(getattr(l, "keys", None)) + _nbytes(getattr(l, "values", None)) for l in obj.layers)
+    if hasattr(obj, "key_cache"):
+        return _nbytes(obj.key_cache) + _nbytes(obj.value_cache)
+    return 0
+
+
+class PrefixKVCache:
+    """
+    LRU cache of past_key_values for the constant prompt header
+    (<SYS> ... </PLAYER_STATE>), keyed by a hash of its token ids
+    (and of the adapter that computed it).
+    Entries are evicted least-recently-used first once `max_bytes` is exceeded.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (past_key_values, nbytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(prefix_ids, namespace: str = "") -> str:
+        ids = prefix_ids.detach().to("cpu", torch.int64).contiguous().numpy()
+        return hashlib.sha1(namespace.encode("utf-8") + b"\0" + ids.tobytes()).hexdigest()
+
+    def get(self, key):
+        """Return a private copy of the cached past_key_values (generate() mutates it), or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            past = entry[0]
+        return copy.deepcopy(past)
+
+    def put(self, key, past_key_values):
+        size = _nbytes(past_key_values)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (past_key_values, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
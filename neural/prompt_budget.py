@@ -0,0 +1,91 @@
+from typing import Dict, List, Optional, Tuple
+
+# Opening markers of the model prompt format, in order (see webtest_prompt._assemble_prompt_for_model).
+# They are special tokens, so tokenizing the sections separately gives the same ids as the whole prompt.
+SECTIONS = [("SYS", "<SYS>"), ("RAG", "<RAG>"), ("PLAYER_STATE", "<PLAYER_STATE>"), ("CTX", "<CTX>"), ("PLAYER", "<PLAYER>")]
+
+
+def _split_sections(prompt: str) -> Optional[List[Tuple[str, str]]]:
+    """[(name, text), ...] split at the opening markers, or None if the prompt isn't in model format."""
+    positions = [prompt.find(marker) for _, marker in SECTIONS[:-1]]
+    positions.append(prompt.rfind("<PLAYER>"))  # the utterance line (CTX lines may quote "<PLAYER>")
+    if any(p < 0 for p in positions) or positions != sorted(positions):
+        return None
+    positions[0] = 0  # anything before <SYS> stays with it
+    bounds = positions + [len(prompt)]
+    return [(name, prompt[bounds[i]:bounds[i + 1]]) for i, (name, _) in enumerate(SECTIONS)]
+
+
+def _shrink_lines(lines: List[List[int]], excess: int) -> int:
+    """Cut tokens off the end of the longest lines first, keeping each line's final (newline) token."""
+    saved = 0
+    while saved < excess and lines:
+        i = max(range(len(lines)), key=lambda k: len(lines[k]))
+        n = len(lines[i])
+        if n <= 1:
+            break
+        other = max((len(l) for k, l in enumerate(lines) if k != i), default=1)
+        cut = min(excess - saved, n - 1, max(n - other, 1))
+        lines[i] = lines[i][:n - 1 - cut] + lines[i][n - 1:]
+        saved += cut
+    return saved
+
+
+def fit_prompt(prompt: str, tokenizer, max_length: int) -> Tuple[List[int], Optional[Dict]]:
+    """
+    Token ids of `prompt` within `max_length` tokens.
+    Over budget, the closing part (<PLAYER> ... <STATE> <NPC>) and every section marker are
+    always kept; RAG text is shortened first, then the oldest CTX lines are dropped, then the
+    PLAYER_STATE / SYS bodies are shortened. Returns (ids, report) where report is None if
+    nothing was trimmed, else {"original_tokens", "final_tokens", "saved": {section: tokens}}.
+    """
+    ids = tokenizer(prompt, add_special_tokens=False)["input_ids"]
+    if len(ids) <= max_length:
+        return ids, None
+
+    sections = _split_sections(prompt)
+    if sections is None:
+        # unknown layout: drop from the front so the closing markers survive
+        kept = ids[-max_length:]
+        return kept, {"original_tokens": len(ids), "final_tokens": len(kept), "saved": {"HEAD": len(ids) - len(kept)}}
+
+    # tokenize every line of every section once
+    section_lines = [text.splitlines(keepends=True) for _, text in sections]
+    flat = [line for lines in section_lines for line in lines]
+    flat_ids = iter(tokenizer(flat, add_special_tokens=False)["input_ids"])
+    tokens = {name: [next(flat_ids) for _ in lines] for (name, _), lines in zip(sections, section_lines)}
+    original = {name: sum(len(l) for l in lines) for name, lines in tokens.items()}
+
+    # marker lines (<X> ... </X>) are protected, only the bodies are trimmed
+    bodies = {name: lines[1:-1] for name, lines in tokens.items() if name != "PLAYER"}
+    excess = sum(original.values()) - max_length
+
+    excess -= _shrink_lines(bodies["RAG"], excess)
+    while excess > 0 and bodies["CTX"]:
+        excess -= len(bodies["CTX"].pop(0))
+    excess -= _shrink_lines(bodies["PLAYER_STATE"], excess)
+    excess -= _shrink_lines(bodies["SYS"], excess)
+
+    head = []
+    for name, _ in SECTIONS[:-1]:
+        lines = tokens[name]
+        tokens[name] = lines[:1] + bodies[name] + lines[-1:] if len(lines) > 1 else lines
+        head += [t for line in tokens[name] for t in line]
+    tail = [t for line in tokens["PLAYER"] for t in line]
+
+    saved = {name: original[name] - sum(len(l) for l in tokens[name]) for name in original}
+    if len(head) + len(tail) > max_length:
+        # only a huge utterance gets here: keep the end of it (and the markers after it)
+        room = max(0, max_length - len(tail))
+        saved["HEAD"] = len(head) - room
+        head = head[len(head) - room:] if room else []
+        if len(tail) > max_length:
+            saved["PLAYER"] += len(tail) - max_length
+            tail = tail[-max_length:]
+
+    kept = head + tail
+    return kept, {
+        "original_tokens": len(ids),
+        "final_tokens": len(kept),
+        "saved": {name: n for name, n in saved.items() if n > 0},
+    }
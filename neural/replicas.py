@@ -0,0 +1,353 @@
+"""
+Multi-replica CPU serving: the model is loaded once, then N worker processes are forked
+from the loaded parent so they share its (read-only) weight pages copy-on-write. Every
+replica is pinned to its own slice of the cores with its own torch thread count, and the
+dispatcher sends each request to the replica with the fewest outstanding requests.
+
+    python replicas.py serve --replicas 4                 # server.py API in front of 4 replicas
+    python replicas.py bench --replicas 1,2,4,8 --requests 64
+
+Linux only (fork + sched_setaffinity). The parent loads with one torch thread so no
+OpenMP pool exists at fork time.
+"""
+import argparse
+import asyncio
+import itertools
+import math
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+
+import torch
+from config import BATCH_MAX_SIZE, REPLICA_THREADS, REPLICAS, SERVE_MAX_WAIT_S, SERVE_QUEUE_MAX
+
+GREEDY = {"do_sample": False, "temperature": None, "top_p": None}
+LIVENESS_INTERVAL_S = 1.0
+
+
+def _memory_mb(pid: int) -> dict:
+    """RSS / PSS / private memory of a process; PSS splits shared pages between their users."""
+    fields = {"Rss": 0, "Pss": 0, "Private_Clean": 0, "Private_Dirty": 0}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in fields:
+                    fields[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return {
+        "rss_mb": round(fields["Rss"] / 1024, 1),
+        "pss_mb": round(fields["Pss"] / 1024, 1),
+        "private_mb": round((fields["Private_Clean"] + fields["Private_Dirty"]) / 1024, 1),
+    }
+
+
+def _split_cores(n: int):
+    cores = sorted(os.sched_getaffinity(0))
+    per = len(cores) // n
+    if per == 0:
+        return [cores] * n
+    return [cores[i * per:(i + 1) * per] for i in range(n)]
+
+
+def _replica_main(index, cores, threads, max_batch, inbox, outbox):
+    """Replica process: drain the inbox, batch jobs with equal gen params, post results."""
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    import inference  # already loaded by the parent: same (shared) weight pages
+
+    while True:
+        jobs = [inbox.get()]
+        while len(jobs) < max_batch:
+            try:
+                jobs.append(inbox.get_nowait())
+            except queue.Empty:
+                break
+        if any(job is None for job in jobs):
+            return
+
+        groups = {}
+        for job in jobs:
+            groups.setdefault(tuple(sorted(job[3].items())), []).append(job)
+        for group in groups.values():
+            start = time.perf_counter()
+            try:
+                results = inference.run_inference_batch(
+                    [job[1] for job in group], gen_params=group[0][3], adapters=[job[2] for job in group]
+                )
+                error = None
+            except Exception as e:
+                results, error = [None] * len(group), repr(e)
+            service = time.perf_counter() - start
+            for job, result in zip(group, results):
+                outbox.put((index, job[0], result, error, start - job[4], service, len(group)))
+
+
+class ReplicaPool:
+    """
+    Same interface as server.InferenceWorker (submit / ready / depth / estimated_wait /
+    stats), backed by forked replica processes and a least-loaded dispatcher.
+    Replicas keep the weights they were forked with, so there is no hot reload.
+    """
+
+    supports_reload = False
+
+    def __init__(self, replicas: int = REPLICAS, threads: int = REPLICA_THREADS,
+                 max_queue: int = SERVE_QUEUE_MAX, max_wait_s: float = SERVE_MAX_WAIT_S,
+                 max_batch: int = BATCH_MAX_SIZE):
+        self.n = max(1, replicas)
+        self.threads = threads
+        self.max_queue = max(1, max_queue)  # per replica
+        self.max_wait_s = max_wait_s
+        self.max_batch = max(1, max_batch)
+        self.inference = None
+        self.error = None
+        self.replicas = []
+        self._pending = {}  # job id -> (loop, future, replica index)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.counters = {"accepted": 0, "rejected_full": 0, "rejected_wait": 0, "completed": 0, "failed": 0}
+
+    @property
+    def ready(self) -> bool:
+        return any(r["alive"] for r in self.replicas)
+
+    def start(self):
+        """Load the model once, then fork the replicas (call before any serving thread exists)."""
+        if self.replicas:
+            return
+        torch.set_num_threads(1)
+        t0 = time.perf_counter()
+        import inference
+        self.inference = inference
+        print(f"model loaded in {time.perf_counter() - t0:.1f}s, forking {self.n} replicas")
+
+        ctx = mp.get_context("fork")
+        self._outbox = ctx.Queue()
+        for i, cores in enumerate(_split_cores(self.n)):
+            inbox = ctx.Queue()
+            threads = self.threads or len(cores)
+            proc = ctx.Process(
+                target=_replica_main, args=(i, cores, threads, self.max_batch, inbox, self._outbox),
+                daemon=True, name=f"neural-replica-{i}",
+            )
+            proc.start()
+            self.replicas.append({
+                "index": i, "process": proc, "inbox": inbox, "cores": cores, "threads": threads,
+                "outstanding": 0, "served": 0, "service_ewma": None, "alive": True,
+            })
+        self._collector = threading.Thread(target=self._collect, daemon=True, name="neural-replica-results")
+        self._collector.start()
+
+    def close(self):
+        for r in self.replicas:
+            r["inbox"].put(None)
+        for r in self.replicas:
+            r["process"].join(timeout=10)
+        self._outbox.put(None)  # stops _collect
+        self._collector.join()
+        self.replicas = []
+
+    def _least_loaded(self):
+        return min((r for r in self.replicas if r["alive"]), key=lambda r: (r["outstanding"], r["served"]))
+
+    def _wait_on(self, r) -> float:
+        return r["outstanding"] * (r["service_ewma"] or 0.0)
+
+    def depth(self) -> int:
+        return sum(r["outstanding"] for r in self.replicas)
+
+    def estimated_wait(self) -> float:
+        return min((self._wait_on(r) for r in self.replicas if r["alive"]), default=0.0)
+
+    async def submit(self, prompt: str, adapter, params: dict):
+        from server import Overloaded
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if not self.ready:
+                raise Overloaded("no live replica" if self.replicas else "replicas are starting", retry_after=10)
+            r = self._least_loaded()
+            wait = self._wait_on(r)
+            if r["outstanding"] >= self.max_queue:
+                self.counters["rejected_full"] += 1
+                raise Overloaded(f"all {self.n} replicas have {self.max_queue} queued", math.ceil(r["service_ewma"] or 1))
+            if wait > self.max_wait_s:
+                self.counters["rejected_wait"] += 1
+                raise Overloaded(f"estimated wait {wait:.1f}s > {self.max_wait_s:.1f}s", math.ceil(wait - self.max_wait_s))
+            job_id = next(self._ids)
+            self._pending[job_id] = (loop, future, r["index"])
+            r["outstanding"] += 1
+            self.counters["accepted"] += 1
+        r["inbox"].put((job_id, prompt, adapter, params, time.perf_counter()))
+        return await future
+
+    def _collect(self):
+        from server import _settle
+
+        checked = time.monotonic()
+        while True:
+            try:
+                item = self._outbox.get(timeout=LIVENESS_INTERVAL_S)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                return
+            if time.monotonic() - checked >= LIVENESS_INTERVAL_S:
+                self._check_liveness()
+                checked = time.monotonic()
+            if not item:
+                continue
+            index, job_id, result, error, wait, service, batch = item
+            with self._lock:
+                entry = self._pending.pop(job_id, None)
+                if entry is None:  # already failed by _check_liveness
+                    continue
+                r = self.replicas[index]
+                r["outstanding"] -= 1
+                r["served"] += 1
+                per_request = service / batch
+                r["service_ewma"] = per_request if r["service_ewma"] is None else 0.8 * r["service_ewma"] + 0.2 * per_request
+                self.counters["failed" if error else "completed"] += 1
+            loop, future, _ = entry
+            loop.call_soon_threadsafe(
+                _settle, future, None if error else (result, wait, service), RuntimeError(error) if error else None
+            )
+
+    def _check_liveness(self):
+        """Mark replicas whose process exited as dead and fail the jobs they still held."""
+        from server import _settle
+
+        with self._lock:
+            lost = []
+            for r in self.replicas:
+                if r["alive"] and not r["process"].is_alive():
+                    r["alive"] = False
+                    r["outstanding"] = 0
+                    print(f"[WARN] replica {r['index']} exited with code {r['process'].exitcode}")
+                    for job_id in [j for j, (_, _, index) in self._pending.items() if index == r["index"]]:
+                        lost.append((self._pending.pop(job_id), r))
+            self.counters["failed"] += len(lost)
+        for (loop, future, _), r in lost:
+            error = RuntimeError(f"replica {r['index']} exited with code {r['process'].exitcode}")
+            loop.call_soon_threadsafe(_settle, future, None, error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            replicas = [
+                {
+                    "index": r["index"], "pid": r["process"].pid, "alive": r["alive"],
+                    "cores": f"{r['cores'][0]}-{r['cores'][-1]}", "threads": r["threads"], "outstanding": r["outstanding"], "served": r["served"],
+                    "service_ewma_ms": round((r["service_ewma"] or 0.0) * 1000, 1),
+                    **_memory_mb(r["process"].pid),
+                }
+                for r in self.replicas
+            ]
+            return {
+                "ready": self.ready,
+                "replicas": replicas,
+                "parent": _memory_mb(os.getpid()),
+                "queue_depth": self.depth(),
+                "estimated_wait_s": round(self.estimated_wait(), 3),
+                **self.counters,
+            }
+
+    def engine_stats(self) -> dict:
+        # prefix cache / budget counters live in the replica processes
+        return {}
+
+
+async def _burst(pool, prompts, params):
+    t0 = time.perf_counter()
+    await asyncio.gather(*(pool.submit(p, None, params) for p in prompts))
+    return time.perf_counter() - t0
+
+
+def _bench_one(n, threads, requests, max_new_tokens, out):
+    """One replica count in a fresh (spawned) process: load, fork, measure, report."""
+    # the largest setup decides the queue bound, so no request is rejected
+    pool = ReplicaPool(replicas=n, threads=threads, max_queue=requests, max_wait_s=float("inf"))
+    pool.start()  # before the imports below, which would load the model with all threads
+    from modules.case_loader import load_cases
+    from webtest_prompt import _assemble_prompt_for_model
+
+    cases = [_assemble_prompt_for_model(c["input"]) for c in load_cases()]
+    prompts = [cases[i % len(cases)] for i in range(requests)]
+    params = {**GREEDY, "max_new_tokens": max_new_tokens}
+    asyncio.run(_burst(pool, prompts[:n], params))  # warm-up, one request per replica
+    dt = asyncio.run(_burst(pool, prompts, params))
+    stats = pool.stats()
+    pool.close()
+    out.put((len(prompts) / dt, stats["replicas"]))
+
+
+def bench(args):
+    """
+    Aggregate turns/sec and per-replica memory for each replica count (same total cores).
+    Every configuration runs in its own spawned process, so no pool is forked from a
+    parent that already holds threads or replicas of a previous run.
+    """
+    ctx = mp.get_context("spawn")
+    print(f"{'replicas':>8s} {'threads':>8s} {'turns/s':>8s} {'speedup':>8s} {'RSS/replica':>12s} "
+          f"{'PSS/replica':>12s} {'private/replica':>16s}")
+    base = None
+    for n in [int(x) for x in args.replicas.split(",")]:
+        out = ctx.Queue()
+        proc = ctx.Process(target=_bench_one, args=(n, args.threads, args.requests, args.max_new_tokens, out))
+        proc.start()
+        while True:
+            try:
+                tps, mem = out.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not proc.is_alive():
+                    raise RuntimeError(f"benchmark run with {n} replicas exited with code {proc.exitcode}")
+        proc.join()
+
+        base = base or tps
+        avg = {key: sum(m[key] for m in mem) / len(mem) for key in ("rss_mb", "pss_mb", "private_mb")}
+        print(f"{n:8d} {mem[0]['threads']:8d} {tps:8.3f} {tps / base:7.2f}x {avg['rss_mb']:10.0f}MB "
+              f"{avg['pss_mb']:10.0f}MB {avg['private_mb']:14.0f}MB")
+    return 0
+
+
+def serve(args):
+    import server
+    import uvicorn
+
+    pool = ReplicaPool(replicas=args.replicas, threads=args.threads)
+    pool.start()  # fork before uvicorn starts its threads
+    server.worker = pool
+    uvicorn.run(server.app, host="0.0.0.0", port=args.port)
+    return 0
+
+
+def main():
+    from config import SERVE_PORT
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("serve", help="server.py API over N replicas")
+    p.add_argument("--replicas", type=int, default=REPLICAS)
+    p.add_argument("--threads", type=int, default=REPLICA_THREADS, help="torch threads per replica (0 = its cores)")
+    p.add_argument("--port", type=int, default=SERVE_PORT)
+    p.set_defaults(fn=serve)
+
+    p = sub.add_parser("bench", help="throughput / memory per replica count")
+    p.add_argument("--replicas", default="1,2,4")
+    p.add_argument("--threads", type=int, default=0, help="torch threads per replica (0 = its cores)")
+    p.add_argument("--requests", type=int, default=64)
+    p.add_argument("--max-new-tokens", type=int, default=32)
+    p.set_defaults(fn=bench)
+
+    args = parser.parse_args()
+    raise SystemExit(args.fn(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+HTTP serving entry point of the neural engine (app.py is the Gradio demo).
+
+    python server.py            # or: uvicorn server:app --host 0.0.0.0 --port 7860
+
+POST /api/predict_main   {"session_id", "npc_id", "prompt", "max_tokens", ...} -> run_inference() result
+GET  /api/health         model / queue state (503 while the model is loading)
+GET  /api/metrics        queue depth, queue wait and service time
+POST /api/ping_reload    {"branch": "latest"} -> zero-downtime reload_model()
+
+Requests are batched by batcher.RequestCoalescer, whose single model thread runs them.
+A request that would overflow the queue (SERVE_QUEUE_MAX) or is expected to wait longer
+than SERVE_MAX_WAIT_S is rejected right away with 503 + Retry-After instead of piling up
+behind the others.
+"""
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import uvicorn
+from batcher import RequestCoalescer
+from config import BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, SERVE_MAX_WAIT_S, SERVE_PORT, SERVE_QUEUE_MAX
+from fastapi import APIRouter, FastAPI
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+class PredictReq(BaseModel):
+    session_id: str = ""
+    npc_id: str = ""
+    prompt: str
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    do_sample: Optional[bool] = None
+    repetition_penalty: Optional[float] = None
+    seed: Optional[int] = None
+    adapter: Optional[str] = None
+
+    def gen_params(self) -> dict:
+        params = {
+            "max_new_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "top_p": self.top_p,
+            "do_sample": self.do_sample,
+            "repetition_penalty": self.repetition_penalty,
+            "seed": self.seed,
+        }
+        return {k: v for k, v in params.items() if v is not None}
+
+
+class ReloadReq(BaseModel):
+    branch: str = "latest"
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = max(1, int(retry_after))
+
+
+def _percentiles(values) -> dict:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {"p50": round(pick(0.5) * 1000, 1), "p95": round(pick(0.95) * 1000, 1), "max": round(ordered[-1] * 1000, 1)}
+
+
+def _settle(future, result=None, error=None):
+    # runs on the event loop
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class InferenceWorker:
+    """
+    Admission control in front of a RequestCoalescer: requests are counted from submit()
+    until answered, and refused once SERVE_QUEUE_MAX are pending or the estimated wait
+    exceeds SERVE_MAX_WAIT_S. The wait is estimated from an EWMA of the per-request
+    service time. The model is loaded on a background thread at start().
+    """
+
+    supports_reload = True
+
+    def __init__(self, max_queue: int = SERVE_QUEUE_MAX, max_wait_s: float = SERVE_MAX_WAIT_S,
+                 max_batch: int = BATCH_MAX_SIZE, max_batch_wait_ms: float = BATCH_MAX_WAIT_MS):
+        self.max_queue = max(1, max_queue)
+        self.max_wait_s = max_wait_s
+        self.max_batch = max(1, max_batch)
+        self.max_batch_wait_ms = max_batch_wait_ms
+        self.inference = None
+        self.coalescer = None
+        self.error = None
+        self._pending = 0  # accepted and not answered yet
+        self._service_ewma = None  # seconds per request
+        self._waits = deque(maxlen=1024)
+        self._services = deque(maxlen=1024)
+        self.counters = {"accepted": 0, "rejected_full": 0, "rejected_wait": 0, "completed": 0, "failed": 0, "batches": 0}
+        self._thread = threading.Thread(target=self._load, daemon=True, name="neural-load")
+
+    @property
+    def ready(self) -> bool:
+        return self.coalescer is not None
+
+    def start(self):
+        self._thread.start()
+
+    def _load(self):
+        try:
+            import inference  # loads the model
+        except Exception as e:
+            self.error = repr(e)
+            print(f"[WARN] Model load failed: {e}")
+            return
+        self.inference = inference
+        self.coalescer = RequestCoalescer(self.max_batch, self.max_batch_wait_ms, infer_fn=self._infer)
+
+    def depth(self) -> int:
+        return self._pending
+
+    def estimated_wait(self) -> float:
+        return self.depth() * (self._service_ewma or 0.0)
+
+    async def submit(self, prompt: str, adapter: Optional[str], params: dict):
+        """Queue one request; returns (result, wait_s, service_s) or raises Overloaded."""
+        if not self.ready:
+            raise Overloaded("model failed to load" if self.error else "model is loading", retry_after=10)
+        wait = self.estimated_wait()
+        if wait > self.max_wait_s:
+            self.counters["rejected_wait"] += 1
+            raise Overloaded(f"estimated wait {wait:.1f}s > {self.max_wait_s:.1f}s", math.ceil(wait - self.max_wait_s))
+        if self._pending >= self.max_queue:
+            self.counters["rejected_full"] += 1
+            raise Overloaded(f"queue full ({self.max_queue})", math.ceil(self._service_ewma or 1))
+
+        self.counters["accepted"] += 1
+        self._pending += 1
+        enqueued = time.perf_counter()
+        try:
+            result, started, service = await self.coalescer.submit(prompt, adapter, params)
+        except Exception:
+            self.counters["failed"] += 1
+            raise
+        finally:
+            self._pending -= 1
+        wait = started - enqueued
+        self._waits.append(wait)
+        self.counters["completed"] += 1
+        return result, wait, service
+
+    def _infer(self, prompts, adapters=None, gen_params=None):
+        # runs on the coalescer's model thread
+        start = time.perf_counter()
+        results = self.inference.run_inference_batch(prompts, gen_params=gen_params, adapters=adapters)
+        service = time.perf_counter() - start
+
+        per_request = service / len(prompts)
+        self._service_ewma = per_request if self._service_ewma is None else 0.8 * self._service_ewma + 0.2 * per_request
+        self._services.append(service)
+        self.counters["batches"] += 1
+        return [(result, start, service) for result in results]
+
+    def stats(self) -> dict:
+        queued = self.coalescer.depth() if self.coalescer is not None else 0
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "queue_depth": queued,
+            "in_service": self._pending - queued,
+            "queue_max": self.max_queue,
+            "max_wait_s": self.max_wait_s,
+            "estimated_wait_s": round(self.estimated_wait(), 3),
+            "service_ewma_ms": round((self._service_ewma or 0.0) * 1000, 1),
+            "wait_ms": _percentiles(list(self._waits)),
+            "service_ms": _percentiles(list(self._services)),
+            **self.counters,
+        }
+
+    def engine_stats(self) -> dict:
+        stats = self.inference.cache_stats()
+        stats["prompt_budget"] = self.inference.budget_stats()
+        return stats
+
+    def reload(self, branch: str) -> dict:
+        return self.inference.reload_model(branch)
+
+
+# replaced by a ReplicaPool when started through replicas.py
+worker = InferenceWorker()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    worker.start()
+    yield
+
+
+app = FastAPI(title="neural-engine", lifespan=lifespan)
+router = APIRouter(prefix="/api")
+
+
+def _unavailable(e: Overloaded):
+    return JSONResponse(status_code=503, content={"detail": str(e)}, headers={"Retry-After": str(e.retry_after)})
+
+
+@router.post("/predict_main")
+async def predict_main(req: PredictReq):
+    if worker.ready and req.adapter is not None and req.adapter not in worker.inference.wrapper.adapters:
+        return JSONResponse(status_code=400, content={"detail": f"unknown adapter '{req.adapter}'"})
+    try:
+        result, wait, service = await worker.submit(req.prompt, req.adapter, req.gen_params())
+    except Overloaded as e:
+        return _unavailable(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"detail": f"inference failed: {e!r}"})
+    return JSONResponse(
+        {"session_id": req.session_id, "npc_id": req.npc_id, **result},
+        headers={"X-Queue-Wait-Ms": f"{wait * 1000:.1f}", "X-Service-Time-Ms": f"{service * 1000:.1f}"},
+    )
+
+
+@router.get("/health")
+async def health():
+    if not worker.ready:
+        status = "failed" if worker.error else "loading"
+        return JSONResponse(status_code=503, content={"status": status, "error": worker.error})
+    return {
+        "status": "ok",
+        "branch": worker.inference.wrapper.branch,
+        "queue_depth": worker.depth(),
+        "estimated_wait_s": round(worker.estimated_wait(), 3),
+    }
+
+
+@router.get("/metrics")
+async def metrics():
+    stats = {"server": worker.stats()}
+    if worker.ready:
+        stats.update(worker.engine_stats())
+    return stats
+
+
+@router.post("/ping_reload")
+async def ping_reload(req: Optional[ReloadReq] = None):
+    if not worker.supports_reload:
+        return JSONResponse(status_code=501, content={
+            "detail": "hot reload is not supported with forked replicas; restart them to change branch"
+        })
+    if not worker.ready:
+        return _unavailable(Overloaded("model is loading", retry_after=10))
+    return worker.reload((req or ReloadReq()).branch)
+
+
+app.include_router(router)
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=SERVE_PORT)
@@ -0,0 +1,87 @@
+import re
+
+import torch
+from config import STOP_MAX_SENTENCES, STOP_NEWLINE, STOP_ON_SPECIALS
+from model_loader import SPECIALS
+from transformers import StoppingCriteria
+
+# sentence terminator (optionally followed by closing quotes/brackets) at a word boundary
+SENTENCE_END = re.compile(r"[.!?。！？…]+[\"'”’)\]]*(?=\s|$)")
+SENTENCE_CHARS = set(".!?。！？…")
+BLANK_LINE = re.compile(r"\n\s*\n")
+
+
+class DialogueStopper(StoppingCriteria):
+    """
+    Ends generation as soon as the NPC utterance is complete:
+      - stop_on_specials: a SPECIALS token (<PLAYER>, <CTX>, <SYS>, ...) was generated
+      - newline: "blank" stops at an empty line, "any" at any line break, "off" never
+      - max_sentences: stop after that many sentences (0 = no limit)
+    The first stop reason of every row is kept in `reasons`.
+    """
+
+    def __init__(self, tokenizer, prompt_len: int, batch_size: int,
+                 stop_on_specials: bool = STOP_ON_SPECIALS,
+                 newline: str = STOP_NEWLINE,
+                 max_sentences: int = STOP_MAX_SENTENCES):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.newline = newline
+        self.max_sentences = max_sentences
+        self.special_ids = {tokenizer.convert_tokens_to_ids(t): t for t in SPECIALS} if stop_on_specials else {}
+        self.reasons = [None] * batch_size
+        self.seen = [prompt_len] * batch_size  # tokens of each row already inspected
+
+    def reset(self):
+        """Forget stop reasons, e.g. before re-running generate() after a failed attempt."""
+        self.reasons = [None] * len(self.reasons)
+        self.seen = [self.prompt_len] * len(self.seen)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for i, row in enumerate(input_ids):
+            if self.reasons[i] is None:
+                # assisted decoding can append several tokens per step: check all of them
+                self.reasons[i] = self._check(row, self.seen[i])
+                self.seen[i] = len(row)
+            done[i] = self.reasons[i] is not None
+        return done
+
+    def _check(self, row, start: int):
+        new = [int(t) for t in row[start:]]
+        for tok in new:
+            if tok in self.special_ids:
+                return f"special_token:{self.special_ids[tok]}"
+
+        text_stops = self.newline != "off" or self.max_sentences > 0
+        if not text_stops or not new:
+            return None
+        # only decode the whole utterance when a new token can end a line/sentence
+        piece = self.tokenizer.decode(new, skip_special_tokens=True)
+        if "\n" not in piece and not SENTENCE_CHARS.intersection(piece):
+            return None
+
+        text = self.tokenizer.decode(row[self.prompt_len:], skip_special_tokens=True).lstrip()
+        if self.newline == "any" and "\n" in text:
+            return "newline"
+        if self.newline == "blank" and BLANK_LINE.search(text):
+            return "blank_line"
+        if self.max_sentences > 0 and len(SENTENCE_END.findall(text)) >= self.max_sentences:
+            return "sentence_limit"
+        return None
+
+    def trim(self, text: str) -> str:
+        """Drop whatever follows the newline that ended the utterance."""
+        text = text.lstrip()
+        if self.newline == "any":
+            return text.split("\n", 1)[0]
+        if self.newline == "blank":
+            return BLANK_LINE.split(text, 1)[0]
+        return text
+
+    def finish_reason(self, i: int, gen_row, eos_ids) -> str:
+        if self.reasons[i] is not None:
+            return self.reasons[i]
+        if any(int(t) in eos_ids for t in gen_row):
+            return "eos"
+        return "max_new_tokens"
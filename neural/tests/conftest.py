@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+# random tiny model + local tokenizer (no Hub access), read by config at import
+os.environ["TINY_MODEL"] = "true"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ATOL = 1e-4
+
+
+@pytest.fixture
+def assert_same_state():
+    """Compare the head outputs (deltas / flags_prob / flags_thr) of two results within ATOL."""
+
+    def check(got, want):
+        for key, value in want["deltas"].items():
+            assert got["deltas"][key] == pytest.approx(value, abs=ATOL)
+        for kind in ("flags_prob", "flags_thr"):
+            assert got[kind].keys() == want[kind].keys()
+            for name, value in want[kind].items():
+                assert got[kind][name] == pytest.approx(value, abs=ATOL)
+
+    return check
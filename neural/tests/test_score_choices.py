@@ -0,0 +1,25 @@
+"""score_choices() against one run_inference() per candidate (tiny model)."""
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import inference  # noqa: E402
+from modules.case_loader import load_cases  # noqa: E402
+from webtest_prompt import _assemble_prompt_for_model  # noqa: E402
+
+GREEDY = {"max_new_tokens": 1, "do_sample": False, "temperature": None, "top_p": None}
+
+
+@pytest.mark.parametrize("candidates", [
+    ["네 이야기를 들려줘."],
+    ["고마워.", "고마워."],
+    ["고마워.", "그건 거짓말이지?", "잘 있어."],
+], ids=["single", "duplicate", "distinct"])
+def test_matches_run_inference(candidates, assert_same_state):
+    pre = load_cases()[0]["input"]
+    got = inference.score_choices(pre, candidates)
+    assert [r["player_utterance"] for r in got] == candidates
+    for result, candidate in zip(got, candidates):
+        prompt = _assemble_prompt_for_model({**pre, "player_utterance": candidate})
+        assert_same_state(result, inference.run_inference(prompt, gen_params=GREEDY))
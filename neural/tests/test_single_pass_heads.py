@@ -0,0 +1,36 @@
+"""Heads from the prefill generate() already runs (single_pass) vs a separate forward pass (tiny model)."""
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import inference  # noqa: E402
+from modules.case_loader import load_cases  # noqa: E402
+from webtest_prompt import _assemble_prompt_for_model  # noqa: E402
+
+GREEDY = {"max_new_tokens": 4, "do_sample": False, "temperature": None, "top_p": None}
+
+
+def _prompts(n):
+    return [_assemble_prompt_for_model(c["input"]) for c in load_cases()[:n]]
+
+
+def test_single_prompt(assert_same_state):
+    prompt = _prompts(1)[0]
+    reused = inference.run_inference(prompt, gen_params=GREEDY, single_pass=True)
+    separate = inference.run_inference(prompt, gen_params=GREEDY, single_pass=False)
+    assert_same_state(reused, separate)
+    assert reused["npc_output_text"] == separate["npc_output_text"]
+
+
+def test_left_padded_batch(assert_same_state):
+    prompts = _prompts(4)
+    reused = inference.run_inference_batch(prompts, gen_params=GREEDY, single_pass=True)
+    separate = inference.run_inference_batch(prompts, gen_params=GREEDY, single_pass=False)
+    for got, want in zip(reused, separate):
+        assert_same_state(got, want)
+
+
+def test_heads_only_prefill(assert_same_state):
+    prompt = _prompts(1)[0]
+    assert_same_state(inference.run_inference(prompt, gen_params=GREEDY), inference.predict_state(prompt))
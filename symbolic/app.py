@@ -8,14 +8,19 @@ from config import (BASE_DIR, EMBEDDER_MODEL_DIR, EMBEDDER_MODEL_NAME,
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
-from manager.dialogue_manager import handle_dialogue
+from manager.dialogue_manager import handle_dialogue, turn_stats
+from manager.trigger_index import forbidden_cascade_stats
+from models.fallback_model import FallbackWorker
 from models.model_loader import load_embedder, load_fallback_model
 from rag.rag_manager import (add_docs, chroma_initialized,
                              load_game_docs_from_disk, set_embedder)
 from schemas import AskReq, AskRes
+from utils.hf_client import neural_client
+from utils.loop_monitor import LoopLagMonitor
 
 templates = Jinja2Templates(directory="templates")
 model_ready = False
+loop_lag = LoopLagMonitor()
 
 async def load_models(app: FastAPI):
     global model_ready
@@ -23,6 +28,7 @@ async def load_models(app: FastAPI):
     fb_tokenizer, fb_model = load_fallback_model(FALLBACK_MODEL_NAME, FALLBACK_MODEL_DIR, token=HF_TOKEN)
     app.state.fallback_tokenizer = fb_tokenizer
     app.state.fallback_model = fb_model
+    app.state.fallback_worker = FallbackWorker(fb_tokenizer, fb_model)
 
     embedder = load_embedder(EMBEDDER_MODEL_NAME, EMBEDDER_MODEL_DIR, token=HF_TOKEN)
     app.state.embedder = embedder
@@ -41,9 +47,15 @@ async def load_models(app: FastAPI):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    await neural_client.start()  # neural 호출용 keep-alive 커넥션 풀
+    loop_lag.start()
     asyncio.create_task(load_models(app))
     yield
     print("🛑 shutting down...")
+    await loop_lag.stop()
+    if getattr(app.state, "fallback_worker", None) is not None:
+        await app.state.fallback_worker.close()
+    await neural_client.aclose()
 
 app = FastAPI(title="neuro-engine", lifespan=lifespan)
 
@@ -74,6 +86,17 @@ async def root(request: Request):
 async def status():
     return {"ready": model_ready}
 
+@app.get("/metrics")
+async def metrics(request: Request):
+    worker = getattr(request.app.state, "fallback_worker", None)
+    return {
+        "hf_client": neural_client.stats(),
+        "event_loop_lag": loop_lag.stats(),
+        "fallback_worker": worker.stats() if worker is not None else None,
+        "forbidden_cascade": forbidden_cascade_stats.stats(),
+        "turns": turn_stats(),
+    }
+
 @app.post("/wake")
 async def wake(request: Request):
     session_id = (await request.json()).get("session_id", "unknown")
@@ -0,0 +1,321 @@
+"""
+Symbolic processor benchmarks (requires the fallback model to be loadable).
+
+    python benchmark.py fallback --concurrency 8   # event-loop lag / latency: inline generate vs FallbackWorker
+    python benchmark.py classify                   # label scoring vs generation: latency + agreement
+    python benchmark.py rules --triggers 1000      # compiled TriggerRuleIndex vs per-trigger checks (no model)
+    python benchmark.py turn --turns 50            # main-path turn latency, eager vs lazy emotion extraction
+"""
+import argparse
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+from config import EMOTION_LABELS, FALLBACK_MODEL_DIR, FALLBACK_MODEL_NAME, HF_TOKEN
+from models.fallback_model import GEN_PARAMS, FallbackWorker, generate_batch, score_batch
+from manager.trigger_index import TriggerRuleIndex
+from models.model_loader import load_fallback_model
+from utils.loop_monitor import LoopLagMonitor
+
+# 금지 트리거 예시 (_llm_trigger_check의 label 후보 역할)
+SAMPLE_CRITERIA = ["딸의 행방", "공장 지하실", "협박", "열쇠의 출처"]
+
+SAMPLE_INPUTS = [
+    "공장 안쪽에 뭐가 있는지 알려줄 수 있어?",
+    "당신 딸을 찾으러 왔어요.",
+    "여기서 당장 나가, 안 그러면 가만 안 둬.",
+    "배고파 보이네요. 이 빵 드실래요?",
+    "그 열쇠는 어디서 구한 거야?",
+    "어젯밤에 무슨 소리 못 들었어?",
+    "미안해요, 제가 너무 늦었죠.",
+    "이 지도에 표시된 곳이 어디야?",
+]
+
+
+def sample_prompts(n: int) -> list:
+    return [
+        f"다음 문장의 화자 감정을 한 단어로 설명하시오.\n\n[문장]\n{SAMPLE_INPUTS[i % len(SAMPLE_INPUTS)]}\n\n정답:"
+        for i in range(n)
+    ]
+
+
+def _ms(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+
+def bench_fallback(args):
+    tokenizer, model = load_fallback_model(FALLBACK_MODEL_NAME, FALLBACK_MODEL_DIR, token=HF_TOKEN)
+    params = {**GEN_PARAMS, "max_new_tokens": args.max_new_tokens}
+    prompts = sample_prompts(args.concurrency)
+    generate_batch(tokenizer, model, prompts[:1], {**params, "max_new_tokens": 1})  # warm-up
+
+    async def _inline(prompt):
+        # 기존 방식: 이벤트 루프 위에서 바로 generate
+        return generate_batch(tokenizer, model, [prompt], params)[0]
+
+    async def _run(mode):
+        monitor = LoopLagMonitor(interval=0.01)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        worker = FallbackWorker(tokenizer, model, max_batch=args.batch_max) if mode == "worker" else None
+        latencies = []
+
+        async def _one(prompt):
+            t0 = time.perf_counter()
+            if worker is None:
+                await _inline(prompt)
+            else:
+                await worker.generate(prompt, params)
+            latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(_one(p) for p in prompts))
+        wall = time.perf_counter() - t0
+        await monitor.stop()
+        mean_batch = 1.0
+        if worker is not None:
+            mean_batch = worker.stats()["mean_batch"]
+            await worker.close()
+        return wall, latencies, monitor.stats(), mean_batch
+
+    print(f"{args.concurrency} concurrent fallback generations, max_new_tokens={args.max_new_tokens}")
+    print(f"{'mode':8s} {'wall':>8s} {'lat p50':>9s} {'lat p99':>9s} {'lag p50':>9s} {'lag p99':>9s} "
+          f"{'lag max':>9s} {'batch':>6s}")
+    for mode in ("inline", "worker"):
+        wall, lat, lag, mean_batch = asyncio.run(_run(mode))
+        print(f"{mode:8s} {wall:7.2f}s {_ms(lat, 0.5):7.0f}ms {_ms(lat, 0.99):7.0f}ms {lag['p50_ms']:7.1f}ms "
+              f"{lag['p99_ms']:7.1f}ms {lag['max_ms']:7.1f}ms {mean_batch:6.2f}")
+    return 0
+
+
+def _match_label(text: str, labels):
+    """생성된 텍스트에서 가장 먼저 나오는 라벨 (없으면 None)."""
+    upper = text.upper()
+    found = [(upper.find(label.upper()), label) for label in labels if label.upper() in upper]
+    return min(found)[1] if found else None
+
+
+def bench_classify(args):
+    """
+    분류형 fallback 호출: 기존 생성(150 토큰 샘플링) vs 라벨 log-prob 점수.
+    agreement = 생성 답을 라벨로 해석할 수 있었던 경우 중 점수 방식과 같은 비율.
+    """
+    from pipeline.preprocess import _emotion_prompt, _parse_yes_no, _trigger_check_prompt
+
+    tokenizer, model = load_fallback_model(FALLBACK_MODEL_NAME, FALLBACK_MODEL_DIR, token=HF_TOKEN)
+    params = {**GEN_PARAMS, "max_new_tokens": args.max_new_tokens}
+    if args.greedy:
+        params.update(do_sample=False, temperature=None, top_p=None)
+
+    tasks = [
+        ("emotion", _emotion_prompt(text), _emotion_prompt(text, EMOTION_LABELS), EMOTION_LABELS,
+         lambda out: _match_label(out, EMOTION_LABELS))
+        for text in SAMPLE_INPUTS
+    ] + [
+        ("trigger", _trigger_check_prompt(text, SAMPLE_CRITERIA), _trigger_check_prompt(text, SAMPLE_CRITERIA),
+         ["YES", "NO"], lambda out: "YES" if _parse_yes_no(out) else "NO")
+        for text in SAMPLE_INPUTS
+    ]
+    score_batch(tokenizer, model, [tasks[0][2]], tuple(tasks[0][3]))  # warm-up
+
+    rows = {}
+    for kind, gen_prompt, score_prompt, labels, parse in tasks:
+        t0 = time.perf_counter()
+        generated = generate_batch(tokenizer, model, [gen_prompt], params)[0]
+        gen_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        label, confidence, _ = score_batch(tokenizer, model, [score_prompt], tuple(labels))[0]
+        score_s = time.perf_counter() - t0
+
+        gen_label = parse(generated)
+        r = rows.setdefault(kind, {"gen": [], "score": [], "parsed": 0, "agree": 0})
+        r["gen"].append(gen_s)
+        r["score"].append(score_s)
+        if gen_label is not None:
+            r["parsed"] += 1
+            r["agree"] += int(gen_label == label)
+        if args.verbose:
+            print(f"[{kind}] gen={gen_label!s:6s} score={label} ({confidence:.2f})  {generated[:40]!r}")
+
+    print(f"{'call':8s} {'n':>3s} {'gen p50':>9s} {'score p50':>10s} {'speedup':>8s} {'parsed':>7s} {'agree':>7s}")
+    for kind, r in rows.items():
+        n = len(r["gen"])
+        agree = r["agree"] / r["parsed"] if r["parsed"] else 0.0
+        print(f"{kind:8s} {n:3d} {_ms(r['gen'], 0.5):7.0f}ms {_ms(r['score'], 0.5):8.0f}ms "
+              f"{_ms(r['gen'], 0.5) / _ms(r['score'], 0.5):7.1f}x {r['parsed']:3d}/{n:<3d} {agree * 100:6.1f}%")
+    return 0
+
+
+def _naive_trigger_match(td_docs, user_input, items, actions, game_state, delta):
+    # 기존 preprocess_input의 trigger_def 검사를 모든 문서에 적용한 것
+    matched = []
+    for td in td_docs:
+        trig = td.get("trigger", {})
+        text_ok = not trig.get("required_text") or any(t in user_input for t in trig["required_text"])
+        items_ok = not trig.get("required_items", {}).get("mandatory") or set(trig["required_items"]["mandatory"]).issubset(set(items))
+        actions_ok = not trig.get("required_actions", {}).get("mandatory") or set(trig["required_actions"]["mandatory"]).issubset(set(actions))
+        gs_ok = not trig.get("required_game_state", {}).get("mandatory") or set(trig["required_game_state"]["mandatory"]).issubset(set(game_state))
+        delta_ok = all(delta.get(k, 0) >= v for k, v in trig.get("required_delta", {}).get("mandatory", {}).items())
+        if text_ok and items_ok and actions_ok and gs_ok and delta_ok:
+            matched.append(td)
+    return matched
+
+
+def _synthetic_triggers(n, rng):
+    words = [f"단서{i}" for i in range(n // 2)] + ["기억", "사진", "공장", "열쇠", "목걸이"]
+    items = [f"item_{i}" for i in range(n // 5 + 1)]
+    actions = [f"action_{i}" for i in range(n // 10 + 1)]
+    states = [f"state_{i}" for i in range(20)]
+    docs = [
+        {
+            "id": f"trigger_{i}",
+            "type": "trigger_def",
+            "priority": rng.choice([0, 0, 0, 1, 2]),
+            "trigger": {
+                "required_text": rng.sample(words, rng.randint(0, 3)),
+                "required_items": {"mandatory": rng.sample(items, rng.randint(0, 2)), "optional": []},
+                "required_actions": {"mandatory": rng.sample(actions, rng.randint(0, 2)), "optional": []},
+                "required_game_state": {"mandatory": rng.sample(states, rng.randint(0, 1)), "optional": []},
+                "required_delta": {"mandatory": {k: round(rng.uniform(-0.5, 0.5), 2)
+                                                 for k in rng.sample(["trust", "relationship"], rng.randint(0, 2))}},
+            },
+        }
+        for i in range(n)
+    ]
+    requests = [
+        (
+            " ".join(rng.sample(words, 4)) + " 그 얘기 좀 해줄래?",
+            rng.sample(items, len(items) // 2),
+            rng.sample(actions, len(actions) // 2),
+            rng.sample(states, 10),
+            {"trust": round(rng.uniform(-0.6, 0.6), 2), "relationship": round(rng.uniform(-0.6, 0.6), 2)},
+        )
+        for _ in range(200)
+    ]
+    return docs, requests
+
+
+def bench_rules(args):
+    rng = random.Random(0)
+    docs, requests = _synthetic_triggers(args.triggers, rng)
+
+    t0 = time.perf_counter()
+    index = TriggerRuleIndex(docs)
+    compile_ms = (time.perf_counter() - t0) * 1000
+
+    def _per_call_us(fn):
+        t0 = time.perf_counter()
+        for _ in range(args.repeat):
+            for req in requests:
+                fn(*req)
+        return (time.perf_counter() - t0) / (args.repeat * len(requests)) * 1e6
+
+    mismatches = sum(
+        {d["id"] for d in index.match(*req)} != {d["id"] for d in _naive_trigger_match(docs, *req)}
+        for req in requests
+    )
+    matched = sum(len(index.match(*req)) for req in requests) / len(requests)
+    naive_us = _per_call_us(lambda *req: _naive_trigger_match(docs, *req))
+    compiled_us = _per_call_us(index.match)
+
+    print(f"{args.triggers} triggers, compile {compile_ms:.1f}ms, {matched:.1f} matched per request, "
+          f"{mismatches} mismatches vs per-trigger checks")
+    print(f"per-trigger loop {naive_us:9.1f}us/request")
+    print(f"compiled index   {compiled_us:9.1f}us/request ({naive_us / compiled_us:.1f}x)")
+    return 1 if mismatches else 0
+
+
+# rag/docs/npc_config.json의 in_progress trigger_def를 만족하는 턴 (main 경로)
+MAIN_PATH_TURN = {
+    "npc_id": "mother_abandoned_factory",
+    "user_input": "이 사진 속 파티, 기억나세요?",
+    "context": {
+        "require": {"items": ["photo_forgotten_party"], "actions": ["visited_factory"], "game_state": [],
+                    "delta": {"trust": 0.4}},
+        "player_state": {"items": ["photo_forgotten_party"], "actions": ["visited_factory"]},
+        "game_state": {"quest_stage": "in_progress", "location": "map1"},
+        "npc_state": {},
+        "npc_config": {"id": "mother_abandoned_factory"},
+        "dialogue_history": [],
+    },
+}
+
+
+async def _turns(args):
+    import app as server
+    import pipeline.preprocess as preprocess
+    from manager.dialogue_manager import handle_dialogue
+    from utils.hf_client import neural_client
+
+    await neural_client.start()
+    await server.load_models(server.app)
+    request = SimpleNamespace(app=server.app)
+    turn = MAIN_PATH_TURN
+
+    async def _one(i):
+        if args.preprocess_only:
+            await preprocess.preprocess_input(request, f"bench-{i}", turn["npc_id"], turn["user_input"], turn["context"])
+        else:
+            await handle_dialogue(request, f"bench-{i}", turn["npc_id"], turn["user_input"], turn["context"])
+
+    rows = []
+    for lazy in (False, True):
+        preprocess.LAZY_EMOTION = lazy
+        await _one(-1)  # warm-up (bundle / index 빌드)
+        latencies = []
+        for i in range(args.turns):
+            t0 = time.perf_counter()
+            await _one(i)
+            latencies.append(time.perf_counter() - t0)
+        rows.append(("lazy" if lazy else "eager", latencies))
+
+    await server.app.state.fallback_worker.close()
+    await neural_client.aclose()
+    return rows
+
+
+def bench_turn(args):
+    """main 경로 턴 지연: 감정 추출을 먼저 await(기존) vs 백그라운드 task + 취소."""
+    rows = asyncio.run(_turns(args))
+    scope = "preprocess_input" if args.preprocess_only else "handle_dialogue"
+    print(f"{args.turns} main-path turns ({scope})")
+    print(f"{'emotion':8s} {'p50':>9s} {'p99':>9s}")
+    for name, latencies in rows:
+        print(f"{name:8s} {_ms(latencies, 0.5):7.0f}ms {_ms(latencies, 0.99):7.0f}ms")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("fallback", help="event-loop lag with inline vs worker-thread fallback generation")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--batch-max", type=int, default=4)
+    p.add_argument("--max-new-tokens", type=int, default=32)
+    p.set_defaults(fn=bench_fallback)
+
+    p = sub.add_parser("classify", help="label scoring vs generation for emotion / trigger checks")
+    p.add_argument("--max-new-tokens", type=int, default=150)
+    p.add_argument("--greedy", action="store_true", help="greedy generation (default: GEN_PARAMS sampling)")
+    p.add_argument("--verbose", action="store_true")
+    p.set_defaults(fn=bench_classify)
+
+    p = sub.add_parser("rules", help="compiled trigger_def rule index vs per-trigger checks")
+    p.add_argument("--triggers", type=int, default=1000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(fn=bench_rules)
+
+    p = sub.add_parser("turn", help="main-path turn latency with eager vs lazy emotion extraction")
+    p.add_argument("--turns", type=int, default=50)
+    p.add_argument("--preprocess-only", action="store_true", help="time preprocess_input only (no neural call)")
+    p.set_defaults(fn=bench_turn)
+
+    args = parser.parse_args()
+    raise SystemExit(args.fn(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,11 +12,45 @@ HF_SERVE_URL = os.getenv("HF_SERVE_URL", "https://m97j-personachatengine-hf-serv
 # Hugging Face Serve Timeout (초)
 HF_TIMEOUT = float(os.getenv("HF_TIMEOUT", "25"))
 
+# Neural 호출용 공유 HTTP 클라이언트 (app 시작 시 1회 생성, keep-alive 재사용)
+HF_HTTP2 = os.getenv("HF_HTTP2", "true").lower() == "true"
+HF_CONNECT_TIMEOUT = float(os.getenv("HF_CONNECT_TIMEOUT", "5"))
+HF_MAX_CONNECTIONS = int(os.getenv("HF_MAX_CONNECTIONS", "20"))
+HF_MAX_KEEPALIVE = int(os.getenv("HF_MAX_KEEPALIVE", "10"))
+HF_KEEPALIVE_EXPIRY = float(os.getenv("HF_KEEPALIVE_EXPIRY", "60"))
+
+# 재시도 (연결 실패 / 502·503·504만, HF_TIMEOUT 전체 예산 안에서)
+HF_RETRIES = int(os.getenv("HF_RETRIES", "2"))
+HF_RETRY_BACKOFF = float(os.getenv("HF_RETRY_BACKOFF", "0.5"))  # 지수 백오프 기준(초), full jitter
+
+# 서킷 브레이커: 연속 실패 N회 → RESET 초 동안 즉시 실패 (fallback 경로로 전환)
+HF_BREAKER_FAILURES = int(os.getenv("HF_BREAKER_FAILURES", "5"))
+HF_BREAKER_RESET_S = float(os.getenv("HF_BREAKER_RESET_S", "30"))
+
 
 # 모델 이름
 FALLBACK_MODEL_NAME = os.getenv("FALLBACK_MODEL_NAME", "skt/ko-gpt-trinity-1.2B-v0.5")
 EMBEDDER_MODEL_NAME = os.getenv("EMBEDDER_MODEL_NAME", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
 
+# fallback 모델 전용 스레드: 동시에 들어온 프롬프트를 모아 배치 generate
+FALLBACK_BATCH_MAX = int(os.getenv("FALLBACK_BATCH_MAX", "4"))
+FALLBACK_BATCH_WAIT_MS = float(os.getenv("FALLBACK_BATCH_WAIT_MS", "15"))
+FALLBACK_MAX_NEW_TOKENS = int(os.getenv("FALLBACK_MAX_NEW_TOKENS", "150"))
+
+# 분류형 fallback 호출(감정, 금지 트리거 YES/NO): "logits" = prefill 1회 라벨 점수 | "generate" = 기존 생성
+FALLBACK_CLASSIFY = os.getenv("FALLBACK_CLASSIFY", "logits").lower()
+EMOTION_LABELS = [e.strip() for e in os.getenv(
+    "EMOTION_LABELS", "분노,슬픔,혼란,기대,무관심,초조함,기쁨,두려움,중립"
+).split(",") if e.strip()]
+
+# 감정 추출을 백그라운드 task로 시작해 fallback 경로에서만 사용 (false = 기존처럼 매 턴 먼저 await)
+LAZY_EMOTION = os.getenv("LAZY_EMOTION", "true").lower() == "true"
+
+# 금지 트리거 cascade 기본 임계값 (forbidden_trigger_list 문서의 "thresholds"로 NPC별 덮어쓰기)
+# 임베딩 유사도 >= ACCEPT → 매칭 / < REJECT → 미매칭 / 그 사이만 LLM 판정
+FORBIDDEN_ACCEPT = float(os.getenv("FORBIDDEN_ACCEPT", "0.75"))
+FORBIDDEN_REJECT = float(os.getenv("FORBIDDEN_REJECT", "0.65"))
+
 # 모델 디렉토리
 FALLBACK_MODEL_DIR = Path(os.getenv("FALLBACK_MODEL_DIR", BASE_DIR / "models" / "fallback-npc-model"))
 EMBEDDER_MODEL_DIR = Path(os.getenv("EMBEDDER_MODEL_DIR", BASE_DIR / "models" / "sentence-embedder"))
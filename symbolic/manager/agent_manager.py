@@ -1,20 +1,48 @@
+import threading
 from typing import Dict, List
 from rag.rag_manager import retrieve
+from .trigger_index import ForbiddenTriggerIndex, TriggerRuleIndex
 
 class NPCAgent:
     def __init__(self, npc_id: str):
         self.npc_id = npc_id
         self.cache: Dict[str, Dict[str, List[dict]]] = {}  # quest_stage:location별 캐시
+        self.trigger_rules: Dict[str, TriggerRuleIndex] = {}  # 번들과 같은 키
+        self.forbidden_indexes: Dict[str, ForbiddenTriggerIndex] = {}
+        self._locks: Dict[str, threading.Lock] = {}  # 키별 빌드 lock
+        self._locks_guard = threading.Lock()
 
-    def load_rag_bundle(self, quest_stage: str, location: str) -> Dict[str, List[dict]]:
+    def _key_lock(self, cache_key: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(cache_key, threading.Lock())
+
+    def load_rag_bundle(self, quest_stage: str, location: str, embedder=None) -> Dict[str, List[dict]]:
         """
         해당 NPC/퀘스트 스테이지/위치의 모든 문서를 한 번에 로드하고 type별로 분류.
         quest_stage/location이 'any'인 문서도 병합.
+        trigger_def 전체는 이때 규칙 인덱스(trigger_rules)로 컴파일하고,
+        embedder가 주어지면 금지 트리거 임베딩 행렬(forbidden_index)도 한 번 계산.
+        (asyncio.to_thread에서 동시에 불릴 수 있음: 키별 lock으로 한 번만 빌드하고,
+        인덱스를 모두 만든 뒤 마지막에 self.cache에 등록)
         """
         cache_key = f"{quest_stage}:{location}"
-        if cache_key in self.cache:
-            return self.cache[cache_key]
+        bundle = self.cache.get(cache_key)
+        if bundle is not None and (embedder is None or cache_key in self.forbidden_indexes):
+            return bundle
+
+        with self._key_lock(cache_key):
+            bundle = self.cache.get(cache_key)
+            if bundle is None:
+                bundle = self._retrieve_bundle(quest_stage, location)
+                self.trigger_rules[cache_key] = TriggerRuleIndex(bundle.get("trigger_def", []))
+                if embedder is not None:
+                    self._build_forbidden_index(cache_key, bundle, embedder)
+                self.cache[cache_key] = bundle
+            elif embedder is not None and cache_key not in self.forbidden_indexes:
+                self._build_forbidden_index(cache_key, bundle, embedder)
+        return bundle
 
+    def _retrieve_bundle(self, quest_stage: str, location: str) -> Dict[str, List[dict]]:
         filters_base = {"npc_id": self.npc_id}
 
         # 1. 정확히 일치
@@ -33,10 +61,18 @@ class NPCAgent:
         for doc in all_docs:
             t = doc.get("type", "unknown")
             bundle.setdefault(t, []).append(doc)
-
-        self.cache[cache_key] = bundle
         return bundle
 
+    def _build_forbidden_index(self, cache_key: str, bundle: Dict[str, List[dict]], embedder):
+        forbidden_doc = bundle.get("forbidden_trigger_list", [{}])[0]
+        self.forbidden_indexes[cache_key] = ForbiddenTriggerIndex(embedder, forbidden_doc)
+
+    def trigger_index(self, quest_stage: str, location: str) -> TriggerRuleIndex:
+        return self.trigger_rules[f"{quest_stage}:{location}"]
+
+    def forbidden_index(self, quest_stage: str, location: str) -> ForbiddenTriggerIndex:
+        return self.forbidden_indexes[f"{quest_stage}:{location}"]
+
 
 class AgentManager:
     def __init__(self):
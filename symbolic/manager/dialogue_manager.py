@@ -1,10 +1,40 @@
+import time
+from collections import deque
+
 from fastapi import Request
-from pipeline.preprocess import preprocess_input
+from pipeline.preprocess import ensure_emotion, preprocess_input
 from pipeline.generator import generate_response
 from pipeline.postprocess import postprocess_fallback, postprocess_main
 from models.fallback_model import generate_fallback_response
+from utils.hf_client import NeuralUnavailable
 from .prompt_builder import build_main_prompt, build_fallback_prompt
 
+# 경로별 턴 지연 시간 (초, 최근 1024턴)
+turn_latency = {"main": deque(maxlen=1024), "fallback": deque(maxlen=1024)}
+
+def turn_stats() -> dict:
+    out = {}
+    for path, values in turn_latency.items():
+        ordered = sorted(values)
+
+        def pick(q):
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1) if ordered else 0.0
+
+        out[path] = {"turns": len(ordered), "p50_ms": pick(0.5), "p99_ms": pick(0.99)}
+    return out
+
+async def _fallback_path(request: Request, pre: dict, session_id: str, npc_id: str) -> dict:
+    # 감정은 fallback 프롬프트에서만 필요 → 여기서 await (preprocess에서 시작된 task)
+    await ensure_emotion(request, pre)
+
+    # fallback prompt 구성 (내부에서 additional_trigger 기반 분기)
+    fb_prompt = build_fallback_prompt(pre, session_id, npc_id)
+
+    # fallback model 호출
+    fb_raw = await generate_fallback_response(request, fb_prompt)
+
+    return await postprocess_fallback(request, pre, fb_raw)
+
 async def handle_dialogue(
     request: Request,
     session_id: str,
@@ -18,32 +48,33 @@ async def handle_dialogue(
       2) main 경로: main prompt → main model → postprocess_pipeline()
       3) fallback 경로: fallback prompt → fallback model → fallback_final_check()
     """
-    # 1. Preprocess
-    pre = await preprocess_input(request, session_id, npc_id, user_input, context)
-
-    # 2. Fallback 경로
-    if not pre.get("is_valid", True):
-        # fallback prompt 구성 (내부에서 additional_trigger 기반 분기)
-        fb_prompt = build_fallback_prompt(pre, session_id, npc_id)
-
-        # fallback model 호출
-        fb_raw = await generate_fallback_response(request, fb_prompt)
-
-        return_payload_fb = postprocess_fallback(request, pre, fb_raw)
-
-        return return_payload_fb
+    started = time.perf_counter()
+    path = "main"
+    try:
+        # 1. Preprocess
+        pre = await preprocess_input(request, session_id, npc_id, user_input, context)
 
-    # 3. Main 경로
-    main_prompt = build_main_prompt(pre, session_id, npc_id)
+        # 2. Fallback 경로
+        if not pre.get("is_valid", True):
+            path = "fallback"
+            return await _fallback_path(request, pre, session_id, npc_id)
 
-    # main model 호출
-    result = await generate_response(session_id, npc_id, main_prompt, max_tokens=200)
+        # 3. Main 경로
+        main_prompt = build_main_prompt(pre, session_id, npc_id)
 
-    # postprocess_pipeline에서 최종 payload 생성
-    return_payload_main = await postprocess_main(
-        request=request,
-        pre_data=pre,           # preprocess 결과 전체 전달
-        model_payload=result,   # main model 출력
-    )
+        # main model 호출 (neural 서버 다운/과부하 시 즉시 fallback 경로로 전환)
+        try:
+            result = await generate_response(session_id, npc_id, main_prompt, max_tokens=200)
+        except NeuralUnavailable as e:
+            print(f"[WARN] neural unavailable, using fallback path: {e}")
+            path = "fallback"
+            return await _fallback_path(request, pre, session_id, npc_id)
 
-    return return_payload_main
+        # postprocess_pipeline에서 최종 payload 생성
+        return await postprocess_main(
+            request=request,
+            pre_data=pre,           # preprocess 결과 전체 전달
+            model_payload=result,   # main model 출력
+        )
+    finally:
+        turn_latency[path].append(time.perf_counter() - started)
@@ -60,6 +60,13 @@ def build_main_prompt(pre: Dict[str, Any], session_id: str, npc_id: str) -> str:
 
 
 
+def _emotion_summary(emotion) -> str:
+    # extract_emotion_via_fallback는 문자열(라벨/짧은 문장)을 돌려줌, {감정: 점수} dict도 허용
+    if isinstance(emotion, dict):
+        return ", ".join(f"{k}:{round(v, 2)}" for k, v in emotion.items())
+    return emotion or "unknown"
+
+
 def build_fallback_prompt(pre: Dict[str, Any], session_id: str, npc_id: str) -> str:
     """
     additional_trigger 값에 따라 일반 fallback / 특수 fallback 프롬프트를 한 함수에서 처리
@@ -108,7 +115,7 @@ MOOD={tags.get("npc_mood","neutral")}
 STYLE={tags.get("style","neutral")}
 ITEMS={items}
 ACTIONS={actions}
-EMOTION_SUMMARY={', '.join([f"{k}:{round(v,2)}" for k,v in pre.get('emotion',{}).items()])}
+EMOTION_SUMMARY={_emotion_summary(pre.get("emotion"))}
 INPUT="{pre['player_utterance']}"
 
 RAG_CONTEXT:
@@ -0,0 +1,263 @@
+import re
+import time
+from bisect import bisect_right
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from config import FORBIDDEN_ACCEPT, FORBIDDEN_REJECT
+
+_NON_WORD = re.compile(r"[\W_]+")
+# 이 글자 수(공백 제외) 이상인 문구는 끝 토큰 뒤에 조사 등이 붙어도 어휘 매칭 ("비밀 통로가")
+LEXICAL_OPEN_END_MIN = 3
+
+
+def normalize_text(text: str) -> str:
+    """
+    어휘 매칭용: 소문자, 공백/구두점은 토큰 경계(공백 하나)로, 앞뒤에도 경계를 붙인다.
+    → 정규화된 문구의 부분 문자열 검색 = 토큰 단위 매칭 (짧은 keyword가 긴 단어 안에서 잡히지 않음).
+    """
+    tokens = _NON_WORD.sub(" ", text.lower()).split()
+    return f" {' '.join(tokens)} " if tokens else ""
+
+
+def encode_normalized(embedder, texts):
+    """L2 정규화된 임베딩 (내적 = 코사인 유사도)."""
+    return embedder.encode(texts, convert_to_tensor=True, normalize_embeddings=True)
+
+
+class ForbiddenTriggerIndex:
+    """
+    forbidden_trigger_list 문서의 keyword / text 임베딩을 번들 로드 시 한 번만 계산해 둔다.
+    요청마다 사용자 입력만 encode(1회) → 행렬곱 1회로 두 집합 모두 비교.
+    정규화된 문구의 Aho–Corasick 오토마톤(어휘 매칭)과 NPC별 cascade 임계값도 함께 보관:
+        "thresholds": {"accept": 0.75, "reject": 0.65, "lexical": true, "llm_judge": true}
+    """
+
+    def __init__(self, embedder, forbidden_doc: dict):
+        forbidden_doc = forbidden_doc or {}
+        triggers = forbidden_doc.get("triggers", {})
+        self.keywords = list(triggers.get("keywords", []))
+        self.texts = list(triggers.get("text", []))
+        phrases = self.keywords + self.texts
+        self.matrix = encode_normalized(embedder, phrases) if phrases else None  # (K+T, D)
+
+        thresholds = forbidden_doc.get("thresholds", {})
+        self.accept = float(thresholds.get("accept", FORBIDDEN_ACCEPT))
+        self.reject = float(thresholds.get("reject", FORBIDDEN_REJECT))
+        self.lexical = bool(thresholds.get("lexical", True))
+        self.llm_judge = bool(thresholds.get("llm_judge", True))
+
+        # 비트 i = self._lexical[i] (keyword 먼저 → 같은 위치에서 keyword 우선)
+        self._lexical: List[str] = []
+        lexicon: Dict[str, int] = {}
+        for phrase in phrases:
+            norm = normalize_text(phrase)
+            if len(norm.replace(" ", "")) >= LEXICAL_OPEN_END_MIN:
+                norm = norm[:-1]  # 시작은 토큰 경계, 끝은 열어 둠
+            # 짧은 문구("검")는 양쪽 경계 필수: "검을"/"검사"는 임베딩 단계에서 판정
+            if norm and norm not in lexicon:
+                lexicon[norm] = 1 << len(self._lexical)
+                self._lexical.append(phrase)
+        self.lexicon = AhoCorasick(lexicon)
+
+    def __bool__(self) -> bool:
+        return self.matrix is not None
+
+    @staticmethod
+    def _best(scores, phrases) -> Tuple[float, Optional[str]]:
+        if not phrases:
+            return 0.0, None
+        score, idx = torch.max(scores, dim=0)
+        return float(score.item()), phrases[int(idx.item())]
+
+    def match(self, input_emb) -> Tuple[Tuple[float, Optional[str]], Tuple[float, Optional[str]]]:
+        """input_emb: 정규화된 (D,) 임베딩 → ((keyword 최고 점수, keyword), (text 최고 점수, text))"""
+        if self.matrix is None:
+            return (0.0, None), (0.0, None)
+        scores = self.matrix @ input_emb.to(self.matrix.device)
+        k = len(self.keywords)
+        return self._best(scores[:k], self.keywords), self._best(scores[k:], self.texts)
+
+    def lexical_match(self, user_input: str) -> Optional[str]:
+        """정규화된 입력에 토큰 단위로 포함된 keyword/text 원문 (없으면 None)."""
+        if not self.lexical:
+            return None
+        found = self.lexicon.search(normalize_text(user_input))
+        if not found:
+            return None
+        return self._lexical[(found & -found).bit_length() - 1]
+
+
+class CascadeStats:
+    """단계별 실행 수 / 결정(exit) 수 / 매칭 수 / 지연 시간."""
+
+    def __init__(self, stages, window: int = 1024):
+        self.stages = {
+            name: {"runs": 0, "exits": 0, "hits": 0, "latency": deque(maxlen=window)} for name in stages
+        }
+        self.requests = 0
+
+    def record(self, stage: str, started: float, exited: bool, hit: bool = False):
+        s = self.stages[stage]
+        s["runs"] += 1
+        s["exits"] += int(exited)
+        s["hits"] += int(hit)
+        s["latency"].append(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        out = {"requests": self.requests}
+        for name, s in self.stages.items():
+            ordered = sorted(s["latency"])
+
+            def pick(q):
+                return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2) if ordered else 0.0
+
+            out[name] = {
+                "runs": s["runs"],
+                "exits": s["exits"],
+                "hits": s["hits"],
+                "run_rate": round(s["runs"] / self.requests, 4) if self.requests else 0.0,
+                "p50_ms": pick(0.5),
+                "p99_ms": pick(0.99),
+            }
+        return out
+
+
+# preprocess_input의 금지 트리거 cascade 통계 (GET /metrics)
+forbidden_cascade_stats = CascadeStats(("lexical", "embedding", "llm"))
+
+
+class AhoCorasick:
+    """
+    required_text 문구 전체에 대한 Aho–Corasick 오토마톤.
+    각 노드의 출력은 '그 문구를 요구하는 트리거들의 비트마스크' → search()가 곧
+    텍스트 조건을 만족한 트리거 마스크를 돌려준다.
+    """
+
+    def __init__(self, phrases: Dict[str, int]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[int] = [0]
+        for phrase, mask in phrases.items():
+            node = 0
+            for ch in phrase:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(0)
+                node = nxt
+            self.out[node] |= mask  # 빈 문구는 루트(항상 매칭)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f].get(ch, 0)
+                self.out[child] |= self.out[self.fail[child]]
+
+    def search(self, text: str) -> int:
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        found = out[0]
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            found |= out[node]
+        return found
+
+
+def _priority(doc: dict) -> float:
+    trig = doc.get("trigger", {})
+    return float(doc.get("priority", trig.get("priority", 0)))
+
+
+def _specificity(trig: dict) -> int:
+    return (
+        len(trig.get("required_text") or [])
+        + sum(len((trig.get(k) or {}).get("mandatory") or [])
+              for k in ("required_items", "required_actions", "required_game_state", "required_delta"))
+    )
+
+
+class TriggerRuleIndex:
+    """
+    번들의 trigger_def 문서 전체를 로드 시 한 번 컴파일한 규칙 인덱스.
+      - 트리거 i = 비트 i (우선순위 순으로 배치: priority 내림차순 → 조건 수 내림차순 → 번들 순서)
+      - required_text: AhoCorasick 1회 스캔 (문구 중 하나라도 포함되면 만족)
+      - required_items/actions/game_state: 심볼 → 그 심볼을 요구하는 트리거 마스크,
+        요청에 없는 심볼들의 마스크 OR = 실패한 트리거
+      - required_delta: 키별 임계값 정렬 + 누적 마스크 → bisect 한 번
+    match()는 모든 트리거를 한 번에 평가해 만족한 trigger_def 문서를 우선순위 순으로 돌려준다.
+    """
+
+    SETS = ("required_items", "required_actions", "required_game_state")
+
+    def __init__(self, td_docs: List[dict]):
+        order = sorted(range(len(td_docs)),
+                       key=lambda i: (-_priority(td_docs[i]), -_specificity(td_docs[i].get("trigger", {})), i))
+        self.docs = [td_docs[i] for i in order]
+        self.all = (1 << len(self.docs)) - 1
+
+        phrases: Dict[str, int] = {}
+        text_required = 0
+        self.symbols: Dict[str, Dict[str, int]] = {name: {} for name in self.SETS}
+        thresholds: Dict[str, List[Tuple[float, int]]] = {}
+        for bit, doc in enumerate(self.docs):
+            trig = doc.get("trigger", {})
+            mask = 1 << bit
+            if trig.get("required_text"):
+                text_required |= mask
+                for phrase in trig["required_text"]:
+                    phrases[phrase] = phrases.get(phrase, 0) | mask
+            for name in self.SETS:
+                for sym in frozenset((trig.get(name) or {}).get("mandatory") or []):
+                    self.symbols[name][sym] = self.symbols[name].get(sym, 0) | mask
+            for key, value in ((trig.get("required_delta") or {}).get("mandatory") or {}).items():
+                thresholds.setdefault(key, []).append((float(value), mask))
+
+        self.automaton = AhoCorasick(phrases)
+        self.text_free = self.all & ~text_required
+        self.symbol_sets = {name: frozenset(syms) for name, syms in self.symbols.items()}
+
+        # key → (정렬된 임계값, 누적 마스크[i] = 앞에서 i개 임계값의 트리거, 이 키가 필요 없는 트리거)
+        self.deltas: Dict[str, Tuple[List[float], List[int], int]] = {}
+        for key, pairs in thresholds.items():
+            pairs.sort(key=lambda p: p[0])
+            cumulative = [0]
+            required = 0
+            for _, mask in pairs:
+                cumulative.append(cumulative[-1] | mask)
+                required |= mask
+            self.deltas[key] = ([v for v, _ in pairs], cumulative, self.all & ~required)
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def match_mask(self, user_input: str, items=(), actions=(), game_state=(), delta: dict = None) -> int:
+        ok = self.text_free | self.automaton.search(user_input)
+        for name, have in zip(self.SETS, (items, actions, game_state)):
+            symbols = self.symbols[name]
+            for sym in self.symbol_sets[name].difference(have):
+                ok &= ~symbols[sym]
+        delta = delta or {}
+        for key, (values, cumulative, free) in self.deltas.items():
+            ok &= free | cumulative[bisect_right(values, delta.get(key, 0))]
+        return ok
+
+    def match(self, user_input: str, items=(), actions=(), game_state=(), delta: dict = None) -> List[dict]:
+        ok = self.match_mask(user_input, items, actions, game_state, delta)
+        matched = []
+        while ok:
+            low = ok & -ok
+            matched.append(self.docs[low.bit_length() - 1])
+            ok ^= low
+        return matched
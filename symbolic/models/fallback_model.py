@@ -1,19 +1,212 @@
+import asyncio
+import functools
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
+from config import FALLBACK_BATCH_MAX, FALLBACK_BATCH_WAIT_MS, FALLBACK_MAX_NEW_TOKENS
 from fastapi import Request
 
-async def generate_fallback_response(request: Request, prompt: str) -> str:
-    tokenizer = request.app.state.fallback_tokenizer
-    model = request.app.state.fallback_model
+GEN_PARAMS = {
+    "max_new_tokens": FALLBACK_MAX_NEW_TOKENS,
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "repetition_penalty": 1.1,
+    "do_sample": True,
+}
 
-    inputs = tokenizer(prompt, return_tensors="pt")
+
+def generate_batch(tokenizer, model, prompts: list, params: dict = GEN_PARAMS) -> list:
+    """
+    left-padding 배치 generate. 프롬프트 이후 새로 생성된 토큰만 디코딩한다.
+    (model 스레드에서만 호출)
+    """
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True)
+    inputs.pop("token_type_ids", None)
     with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=150,
-            temperature=0.7,
-            top_p=0.9,
-            repetition_penalty=1.1,
-            do_sample=True
-        )
-    decoded = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    return decoded[len(prompt):].strip() or "..."
\ No newline at end of file
+        outputs = model.generate(**inputs, pad_token_id=tokenizer.pad_token_id, **params)
+    new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+    return [tokenizer.decode(t, skip_special_tokens=True).strip() or "..." for t in new_tokens]
+
+
+def _position_ids(attention_mask):
+    # left padding에서도 실제 토큰 위치가 0부터 시작하도록 (generate 밖에서 forward할 때 필요)
+    return (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+
+def _expand_cache(past, repeats: int):
+    """배치 차원으로 각 행의 KV를 `repeats`번씩 복제 (행 순서: 0,0,..,1,1,..)."""
+    if hasattr(past, "batch_repeat_interleave"):  # DynamicCache
+        past.batch_repeat_interleave(repeats)
+        return past
+    return tuple(tuple(t.repeat_interleave(repeats, dim=0) for t in layer) for layer in past)
+
+
+def score_batch(tokenizer, model, prompts: list, labels: tuple) -> list:
+    """
+    생성 없이 forward만으로 라벨 분류.
+    각 프롬프트 뒤에 올 라벨의 log-probability를 비교해 (label, confidence, {label: prob})를 돌려준다.
+      - 라벨 첫 토큰이 모두 다르면: 프롬프트만 forward → 다음 토큰 분포에서 첫 토큰 비교
+      - 아니면: 프롬프트 prefill의 KV를 라벨 수만큼 복제하고 라벨 토큰만 한 번 더 forward
+        → 라벨 토큰 log-prob의 평균 비교 (합이면 토큰이 많은 라벨이 항상 불리하므로 길이 정규화)
+    (model 스레드에서만 호출)
+    """
+    label_ids = [tokenizer(" " + label, add_special_tokens=False)["input_ids"] for label in labels]
+    firsts = [ids[0] for ids in label_ids]
+    distinct = len(set(firsts)) == len(firsts)
+
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True)
+    mask = inputs["attention_mask"]
+    with torch.no_grad():
+        out = model(input_ids=inputs["input_ids"], attention_mask=mask,
+                    position_ids=_position_ids(mask), use_cache=not distinct)
+    scores = torch.log_softmax(out.logits[:, -1, :].float(), dim=-1)[:, firsts]  # (P, L)
+
+    if not distinct:
+        n = len(labels)
+        width = max(len(ids) for ids in label_ids)
+        pad = tokenizer.pad_token_id
+        # 행 r = 프롬프트 r // n, 라벨 r % n (라벨은 오른쪽 padding)
+        input_ids = torch.tensor([ids + [pad] * (width - len(ids)) for ids in label_ids]).repeat(len(prompts), 1)
+        label_mask = torch.tensor([[1] * len(ids) + [0] * (width - len(ids)) for ids in label_ids])
+        label_mask = label_mask.repeat(len(prompts), 1)
+        # 라벨 토큰 위치는 각 프롬프트의 실제 길이부터 이어진다
+        positions = mask.sum(-1).repeat_interleave(n).unsqueeze(1) + torch.arange(width)
+        with torch.no_grad():
+            logits = model(
+                input_ids=input_ids,
+                attention_mask=torch.cat([mask.repeat_interleave(n, dim=0), label_mask], dim=1),
+                position_ids=positions,
+                past_key_values=_expand_cache(out.past_key_values, n),
+            ).logits
+        # 라벨 토큰 j(≥1)는 위치 j-1의 logits로 예측된다
+        logprobs = torch.log_softmax(logits[:, :-1, :].float(), dim=-1)
+        rest = logprobs.gather(-1, input_ids[:, 1:].unsqueeze(-1)).squeeze(-1) * label_mask[:, 1:]
+        rest = rest.sum(-1).view(len(prompts), n)
+        scores = (scores + rest) / torch.tensor([float(len(ids)) for ids in label_ids])
+
+    probs = torch.softmax(scores, dim=-1)
+    results = []
+    for row in probs:
+        best = int(row.argmax())
+        results.append((labels[best], float(row[best]), {label: round(float(p), 4) for label, p in zip(labels, row)}))
+    return results
+
+
+class FallbackWorker:
+    """
+    fallback 모델 전용 스레드 + asyncio 큐.
+    이벤트 루프는 future만 기다리고, 동시에 들어온 프롬프트는 최대 `max_batch`개까지
+    `max_wait_ms` 동안 모아서 한 번의 generate(또는 score) 배치로 처리한다.
+    """
+
+    def __init__(self, tokenizer, model, max_batch: int = FALLBACK_BATCH_MAX,
+                 max_wait_ms: float = FALLBACK_BATCH_WAIT_MS):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fallback-model")
+        self._queue = None
+        self._task = None
+        self.batch_sizes = Counter()
+        self.busy_s = {"generate": 0.0, "score": 0.0}
+        self.requests = 0
+
+    def _ensure_task(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _submit(self, kind: str, prompt: str, arg):
+        self._ensure_task()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((kind, prompt, arg, fut))
+        return await fut
+
+    async def generate(self, prompt: str, params: dict = GEN_PARAMS) -> str:
+        return await self._submit("generate", prompt, params)
+
+    async def score(self, prompt: str, labels) -> tuple:
+        """(label, confidence, {label: prob}) — score_batch 참고"""
+        return await self._submit("score", prompt, tuple(labels))
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # 같은 종류 + 같은 생성 파라미터(또는 라벨 집합)끼리만 한 배치로
+            groups = {}
+            for item in batch:
+                kind, _, arg, _ = item
+                key = (kind, tuple(sorted(arg.items())) if kind == "generate" else arg)
+                groups.setdefault(key, []).append(item)
+            for (kind, _), group in groups.items():
+                group = [item for item in group if not item[3].cancelled()]
+                if not group:
+                    continue
+                self.requests += len(group)
+                self.batch_sizes[len(group)] += 1
+                fn = generate_batch if kind == "generate" else score_batch
+                started = time.perf_counter()
+                try:
+                    results = await loop.run_in_executor(
+                        self._executor,
+                        functools.partial(fn, self.tokenizer, self.model, [item[1] for item in group], group[0][2]),
+                    )
+                except Exception as e:
+                    for item in group:
+                        if not item[3].done():
+                            item[3].set_exception(e)
+                    continue
+                finally:
+                    self.busy_s[kind] += time.perf_counter() - started
+                for item, result in zip(group, results):
+                    if not item[3].done():
+                        item[3].set_result(result)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        return {
+            "requests": self.requests,
+            "batches": batches,
+            "mean_batch": round(self.requests / batches, 2) if batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "busy_s": {kind: round(v, 2) for kind, v in self.busy_s.items()},
+        }
+
+
+async def generate_fallback_response(request: Request, prompt: str) -> str:
+    return await request.app.state.fallback_worker.generate(prompt)
+
+
+async def classify_fallback_response(request: Request, prompt: str, labels) -> tuple:
+    """
+    분류형 호출(YES/NO, 감정 라벨 등)용: 생성 대신 prefill 1회로 라벨 log-prob 비교 → (label, confidence).
+    """
+    label, confidence, _ = await request.app.state.fallback_worker.score(prompt, labels)
+    return label, confidence
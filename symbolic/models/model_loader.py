@@ -15,6 +15,11 @@ def load_fallback_model(model_name: str, model_dir: Path, token: str = None):
 
     tokenizer = AutoTokenizer.from_pretrained(str(model_dir), trust_remote_code=True, local_files_only=True)
     model = AutoModelForCausalLM.from_pretrained(str(model_dir), trust_remote_code=True, local_files_only=True)
+    model.eval()
+    # 배치 generate용 left padding
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
     return tokenizer, model
 
 
@@ -1,9 +1,10 @@
-import json, torch
+import asyncio, json, time
 from fastapi import Request
+from config import EMOTION_LABELS, FALLBACK_CLASSIFY, LAZY_EMOTION
 from manager.agent_manager import agent_manager
-from models.fallback_model import generate_fallback_response
+from manager.trigger_index import encode_normalized, forbidden_cascade_stats
+from models.fallback_model import classify_fallback_response, generate_fallback_response
 from utils.context_parser import ContextParser
-from sentence_transformers import util
 
 def _short_history(context: dict, max_turns: int = 3) -> list:
     short_history = []
@@ -22,19 +23,16 @@ def _short_history(context: dict, max_turns: int = 3) -> list:
 #     except Exception:
 #         return {}
 
-def _semantic_match_embedder(embedder, user_input: str, trigger_texts: list, threshold: float = 0.75):
-    if not trigger_texts:
-        return (False, 0.0, None)
-    inp_emb = embedder.encode(user_input, convert_to_tensor=True)
-    trg_embs = embedder.encode(trigger_texts, convert_to_tensor=True)
-    cos_scores = util.cos_sim(inp_emb, trg_embs).squeeze(0)
-    max_score, idx = torch.max(cos_scores, dim=0)
-    score_val = float(max_score.item())
-    matched_text = trigger_texts[int(idx.item())]
-    return (score_val >= threshold, score_val, matched_text)
-
-async def extract_emotion_via_fallback(request: Request, user_input: str) -> str:
-    prompt = (
+def _emotion_prompt(user_input: str, labels: list = None) -> str:
+    if labels:
+        # 라벨 점수 방식: 고정 라벨 중 하나로 답하도록
+        return (
+            "다음 문장의 화자 감정을 아래 보기 중 하나로 고르시오.\n\n"
+            f"[문장]\n{user_input}\n\n"
+            f"보기: {', '.join(labels)}\n\n"
+            "정답:"
+        )
+    return (
         "다음 문장의 화자 감정을 한 단어 또는 짧은 문장으로 설명하시오.\n\n"
         f"[문장]\n{user_input}\n\n"
         "지시:\n- 감정을 직접적으로 표현하지 않아도 문맥을 통해 추론하시오.\n"
@@ -43,14 +41,10 @@ async def extract_emotion_via_fallback(request: Request, user_input: str) -> str
         "- 단어 하나 또는 짧은 문장으로만 출력하시오.\n\n"
         "정답:"
     )
-    response = await generate_fallback_response(request, prompt)
-    return response.strip()
 
-async def _llm_trigger_check(request: Request, user_input: str, label_list: list) -> bool:
-    if not label_list:
-        return False
+def _trigger_check_prompt(user_input: str, label_list: list) -> str:
     criteria_block = "\n".join(f"- {c}" for c in label_list)
-    prompt = (
+    return (
         "다음은 의미 비교를 위한 판단 기준과 검사 대상입니다.\n\n"
         "[CRITERIA]\n"
         f"{criteria_block}\n"
@@ -64,7 +58,8 @@ async def _llm_trigger_check(request: Request, user_input: str, label_list: list
         "- 확신이 없거나 판단이 애매하면 NO를 출력하시오.\n\n"
         "정답:"
     )
-    txt = await generate_fallback_response(request, prompt)
+
+def _parse_yes_no(txt: str) -> bool:
     ans = txt.strip().upper()
     normalized = ans.replace(".", "").replace("!", "").strip()
     return (
@@ -76,6 +71,83 @@ async def _llm_trigger_check(request: Request, user_input: str, label_list: list
         normalized.startswith("네")
     )
 
+async def extract_emotion_via_fallback(request: Request, user_input: str) -> str:
+    if FALLBACK_CLASSIFY == "logits":
+        label, _ = await classify_fallback_response(request, _emotion_prompt(user_input, EMOTION_LABELS), EMOTION_LABELS)
+        return label
+    response = await generate_fallback_response(request, _emotion_prompt(user_input))
+    return response.strip()
+
+async def _llm_trigger_check(request: Request, user_input: str, label_list: list) -> bool:
+    if not label_list:
+        return False
+    prompt = _trigger_check_prompt(user_input, label_list)
+    if FALLBACK_CLASSIFY == "logits":
+        label, _ = await classify_fallback_response(request, prompt, ["YES", "NO"])
+        return label == "YES"
+    txt = await generate_fallback_response(request, prompt)
+    return _parse_yes_no(txt)
+
+async def ensure_emotion(request: Request, pre: dict) -> str:
+    """
+    fallback 경로에서 감정이 필요할 때 호출: 백그라운드 task 결과를 기다리고,
+    (main 경로에서 취소된 뒤 neural 장애로 fallback된 경우처럼) task가 없으면 지금 추출.
+    """
+    task = pre.pop("emotion_task", None)
+    if pre.get("emotion") is None:
+        if task is not None and not task.cancelled():
+            pre["emotion"] = await task
+        else:
+            pre["emotion"] = await extract_emotion_via_fallback(request, pre["player_utterance"])
+    return pre["emotion"]
+
+async def _forbidden_trigger_cascade(request: Request, embedder, index, user_input: str):
+    """
+    금지 트리거 판정, 확실해지는 단계에서 바로 종료:
+      1) 어휘: 정규화된 입력에 keyword/text가 토큰 단위로 포함 → 매칭
+      2) 임베딩: 최고 유사도 >= accept → 매칭, < reject → 미매칭 (NPC별 임계값)
+      3) LLM: 그 사이(gray zone)에서만 YES/NO 판정
+    반환: (matched_key, confidence, kw_match, txt_match)
+    """
+    stats = forbidden_cascade_stats
+    stats.requests += 1
+    if not index:
+        return None, 0.0, None, None
+
+    # 1. 어휘 매칭
+    started = time.perf_counter()
+    phrase = index.lexical_match(user_input)
+    if index.lexical:
+        stats.record("lexical", started, exited=phrase is not None, hit=phrase is not None)
+    if phrase is not None:
+        if phrase in index.keywords:
+            return "lexical_match", 1.0, phrase, None
+        return "lexical_match", 1.0, None, phrase
+
+    # 2. 임베딩 유사도 (keyword/text 행렬은 번들 로드 시 계산됨 → 입력만 1회 encode)
+    started = time.perf_counter()
+    (kw_score, kw_match), (txt_score, txt_match) = index.match(encode_normalized(embedder, user_input))
+    best = max(kw_score, txt_score)
+    if best >= index.accept:
+        stats.record("embedding", started, exited=True, hit=True)
+        # 유사도 높은 쪽 선택
+        if kw_score >= txt_score:
+            return "keyword_match", kw_score, kw_match, txt_match
+        return "text_match", txt_score, kw_match, txt_match
+    if best < index.reject or not index.llm_judge:
+        stats.record("embedding", started, exited=True)
+        return None, 0.0, kw_match, txt_match
+    stats.record("embedding", started, exited=False)
+
+    # 3. gray zone: 가장 가까운 keyword와 text만 label 후보로 LLM 판정
+    started = time.perf_counter()
+    label_candidates = [m for m in (kw_match, txt_match) if m]
+    hit = await _llm_trigger_check(request, user_input, label_candidates)
+    stats.record("llm", started, exited=True, hit=hit)
+    if hit:
+        return "semantic_match_llm", best, kw_match, txt_match
+    return None, 0.0, kw_match, txt_match
+
 async def preprocess_input(
     request: Request,
     session_id: str,
@@ -84,7 +156,21 @@ async def preprocess_input(
     context: dict
 ) -> dict:
     parser = ContextParser(context)
-    emotion = await extract_emotion_via_fallback(request, user_input)
+    # 감정은 fallback 프롬프트에서만 쓰임 → 번들 로드/트리거 검사와 동시에 백그라운드로 추출,
+    # main 경로면 취소 (LAZY_EMOTION=false면 기존처럼 먼저 추출)
+    emotion, emotion_task = None, None
+    if LAZY_EMOTION:
+        emotion_task = asyncio.create_task(extract_emotion_via_fallback(request, user_input))
+    else:
+        emotion = await extract_emotion_via_fallback(request, user_input)
+    try:
+        return await _preprocess(request, session_id, npc_id, user_input, context, parser, emotion, emotion_task)
+    except BaseException:
+        if emotion_task is not None:
+            emotion_task.cancel()
+        raise
+
+async def _preprocess(request, session_id, npc_id, user_input, context, parser, emotion, emotion_task) -> dict:
 
     require_items = context.get("require", {}).get("items", [])
     require_actions = context.get("require", {}).get("actions", [])
@@ -96,81 +182,54 @@ async def preprocess_input(
 
     # --- RAG bundle 로드 ---
     agent = agent_manager.get_agent(npc_id)
-    bundle = agent.load_rag_bundle(quest_stage, location)
+    embedder = request.app.state.embedder
+    # (동기 RAG 조회/인덱스 빌드는 스레드에서 → 그동안 감정 task가 fallback 워커에 올라감)
+    bundle = await asyncio.to_thread(agent.load_rag_bundle, quest_stage, location, embedder)
 
     # === 1차 검사: trigger_def 기반 ===
+    # 번들의 trigger_def 전체를 한 번에 평가 (우선순위 순), 최상위 트리거로 메인 경로 진행
     td_docs = bundle.get("trigger_def", [])
-    if td_docs:
-        td = td_docs[0]
-        trig = td.get("trigger", {})
-
-        text_ok = not trig.get("required_text") or any(t in user_input for t in trig["required_text"])
-        items_ok = not trig.get("required_items", {}).get("mandatory") or set(trig["required_items"]["mandatory"]).issubset(set(require_items))
-        actions_ok = not trig.get("required_actions", {}).get("mandatory") or set(trig["required_actions"]["mandatory"]).issubset(set(require_actions))
-        gs_ok = not trig.get("required_game_state", {}).get("mandatory") or set(trig["required_game_state"]["mandatory"]).issubset(set(require_game_state))
-        delta_ok = all(require_delta.get(k, 0) >= v for k, v in trig.get("required_delta", {}).get("mandatory", {}).items())
-
-        if text_ok and items_ok and actions_ok and gs_ok and delta_ok:
-            return {
-                "session_id": session_id,
-                "player_utterance": user_input,
-                "npc_id": npc_id,
-                "tags": parser.npc,
-                "player_state": parser.player,
-                "game_state": parser.game,
-                "context": _short_history(context),
-                "emotion": emotion,
-                "triggers": trig,
-                "is_valid": True,
-                "additional_trigger": None,
-                "rag_main_docs": (
-                    td_docs
-                    + bundle.get("lore", [])
-                    + bundle.get("description", [])
-                    + bundle.get("npc_persona", [])
-                    + bundle.get("dialogue_turn", [])
-                    + bundle.get("flag_def", [])
-                    + bundle.get("main_res_validate", [])
-                ),
-                "rag_fallback_docs": bundle.get("fallback", []) + bundle.get("npc_persona", []),
-                "trigger_meta": {}
-            }
-
-    # === 2차 검사: forbidden-trigger 기반 ===
-    forbidden_data = bundle.get("forbidden_trigger_list", [{}])[0]
-    keywords = forbidden_data.get("triggers", {}).get("keywords", [])
-    trigger_texts = forbidden_data.get("triggers", {}).get("text", [])
+    matched_triggers = agent.trigger_index(quest_stage, location).match(
+        user_input,
+        items=require_items,
+        actions=require_actions,
+        game_state=require_game_state,
+        delta=require_delta,
+    )
+    if matched_triggers:
+        trig = matched_triggers[0].get("trigger", {})
+        if emotion_task is not None:
+            emotion_task.cancel()
+        return {
+            "session_id": session_id,
+            "player_utterance": user_input,
+            "npc_id": npc_id,
+            "tags": parser.npc,
+            "player_state": parser.player,
+            "game_state": parser.game,
+            "context": _short_history(context),
+            "emotion": emotion,
+            "triggers": trig,
+            "matched_triggers": [td.get("id") for td in matched_triggers],
+            "is_valid": True,
+            "additional_trigger": None,
+            "rag_main_docs": (
+                td_docs
+                + bundle.get("lore", [])
+                + bundle.get("description", [])
+                + bundle.get("npc_persona", [])
+                + bundle.get("dialogue_turn", [])
+                + bundle.get("flag_def", [])
+                + bundle.get("main_res_validate", [])
+            ),
+            "rag_fallback_docs": bundle.get("fallback", []) + bundle.get("npc_persona", []),
+            "trigger_meta": {}
+        }
 
-    embedder = request.app.state.embedder
-    matched_key = None
-    confidence = 0.0
-    kw_match = None
-    txt_match = None
-
-    # 1. keyword 유사도 검사
-    kw_hit, kw_score, kw_match = _semantic_match_embedder(embedder, user_input, keywords, threshold=0.75)
-
-    # 2. text 유사도 검사
-    txt_hit, txt_score, txt_match = _semantic_match_embedder(embedder, user_input, trigger_texts, threshold=0.75)
-
-    # 3. 유사도 높은 쪽 선택
-    if kw_hit and (kw_score >= txt_score):
-        matched_key = "keyword_match"
-        confidence = kw_score
-    elif txt_hit:
-        matched_key = "text_match"
-        confidence = txt_score
-    elif max(kw_score, txt_score) >= 0.65:
-        # 가장 가까운 keyword와 text만 label 후보로 전달
-        label_candidates = []
-        if kw_match:
-            label_candidates.append(kw_match)
-        if txt_match:
-            label_candidates.append(txt_match)
-
-        if await _llm_trigger_check(request, user_input, label_candidates):
-            matched_key = "semantic_match_llm"
-            confidence = max(kw_score, txt_score)
+    # === 2차 검사: forbidden-trigger 기반 (어휘 → 임베딩 → LLM cascade) ===
+    matched_key, confidence, kw_match, txt_match = await _forbidden_trigger_cascade(
+        request, embedder, agent.forbidden_index(quest_stage, location), user_input
+    )
 
     # === trigger_meta 매칭 보정 ===
     actual_trigger = None
@@ -197,6 +256,7 @@ async def preprocess_input(
         "game_state": parser.game,
         "context": _short_history(context),
         "emotion": emotion,
+        "emotion_task": emotion_task,
         "triggers": [],
         "is_valid": False,
         "additional_trigger": additional_trigger,
@@ -1,17 +1,274 @@
+import asyncio
+import random
+import time
+from typing import Any, Dict, Optional
+
 import httpx
-from typing import Any, Dict
-from config import HF_SERVE_URL, HF_TIMEOUT
+from config import (HF_BREAKER_FAILURES, HF_BREAKER_RESET_S, HF_CONNECT_TIMEOUT,
+                    HF_HTTP2, HF_KEEPALIVE_EXPIRY, HF_MAX_CONNECTIONS,
+                    HF_MAX_KEEPALIVE, HF_RETRIES, HF_RETRY_BACKOFF,
+                    HF_SERVE_URL, HF_TIMEOUT)
+
+# 재시도 대상: 요청이 neural 쪽에서 처리되지 않았거나(연결 실패) 서버가 일시적으로 거절한 경우
+RETRY_STATUS = {502, 503, 504}
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+
+# 지연 시간 히스토그램 버킷 (ms, 누적 아님)
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+
+class NeuralUnavailable(Exception):
+    """
+    neural 서버를 지금 쓸 수 없음 (브레이커 open, 재시도 소진, 타임아웃).
+    dialogue_manager는 이 예외를 받으면 fallback 경로로 전환한다.
+    """
+
+
+class CircuitBreaker:
+    """
+    closed → (연속 실패 failures회) → open → (reset_s 경과) → half_open
+    half_open에서는 probe 요청 1개만 통과시키고, 성공하면 closed / 실패하면 다시 open.
+    """
+
+    def __init__(self, failures: int = HF_BREAKER_FAILURES, reset_s: float = HF_BREAKER_RESET_S):
+        self.failures = max(1, failures)
+        self.reset_s = reset_s
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.opened = 0  # open 전환 횟수
+        self.rejected = 0  # open 상태에서 즉시 실패시킨 호출 수
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_s:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def release(self):
+        self._probing = False
+
+    def record(self, ok: bool):
+        self._probing = False
+        if ok:
+            self.state = "closed"
+            self.consecutive = 0
+            return
+        self.consecutive += 1
+        if self.state == "half_open" or self.consecutive >= self.failures:
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def retry_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.reset_s - (time.monotonic() - self.opened_at))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive,
+            "opened": self.opened,
+            "rejected": self.rejected,
+            "retry_in_s": round(self.retry_in(), 1),
+        }
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 마지막 칸 = +Inf
+        self.total = 0
+        self.sum_ms = 0.0
+
+    def observe(self, ms: float):
+        i = 0
+        while i < len(self.buckets) and ms > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        self.sum_ms += ms
+
+    def quantile(self, q: float) -> Optional[float]:
+        """버킷 상한으로 근사한 분위수 (ms)."""
+        if not self.total:
+            return None
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def stats(self) -> Dict[str, Any]:
+        labels = [f"le_{b}" for b in self.buckets] + ["le_inf"]
+        return {
+            "count": self.total,
+            "mean_ms": round(self.sum_ms / self.total, 1) if self.total else 0.0,
+            "p50_le_ms": self.quantile(0.5),
+            "p99_le_ms": self.quantile(0.99),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None  # HTTP-date 형식은 무시하고 백오프 사용
+
+
+class NeuralClient:
+    """
+    neural(HF Space) 호출용 공유 httpx.AsyncClient.
+    app lifespan에서 start()/aclose() — 요청마다 TCP/TLS 핸드셰이크를 새로 하지 않는다.
+    """
+
+    def __init__(self, base_url: str = HF_SERVE_URL, timeout: float = HF_TIMEOUT, retries: int = HF_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.breaker = CircuitBreaker()
+        self._client: Optional[httpx.AsyncClient] = None
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.counters = {"calls": 0, "ok": 0, "failed": 0, "retries": 0, "fast_failed": 0}
+
+    async def start(self):
+        if self._client is not None:
+            return
+        http2 = HF_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401  (httpx[http2])
+            except ImportError:
+                print("[WARN] h2 not installed, using HTTP/1.1 for neural calls")
+                http2 = False
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(self.timeout, connect=HF_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HF_MAX_CONNECTIONS,
+                max_keepalive_connections=HF_MAX_KEEPALIVE,
+                keepalive_expiry=HF_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _observe(self, endpoint: str, outcome: str, started: float):
+        key = f"{endpoint}:{outcome}"
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        self.histograms[key].observe((time.perf_counter() - started) * 1000)
+
+    async def post(self, endpoint: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        재시도는 전체 timeout 예산 안에서만 한다. 503의 Retry-After가 남은 예산보다 길면
+        기다리지 않고 바로 NeuralUnavailable. 500 등 나머지 5xx는 재시도 없이 NeuralUnavailable
+        (브레이커 실패), 4xx는 그대로 raise.
+        """
+        if self._client is None:
+            await self.start()  # lifespan 밖(스크립트 등)에서 호출된 경우
+        self.counters["calls"] += 1
+        if not self.breaker.allow():
+            self.counters["fast_failed"] += 1
+            raise NeuralUnavailable(f"circuit open, retry in {self.breaker.retry_in():.0f}s")
+
+        url = f"{self.base_url}{endpoint}"
+        started = time.perf_counter()
+        deadline = started + self.timeout
+        attempt = 0
+        while True:
+            remaining = deadline - time.perf_counter()
+            delay = None
+            try:
+                response = await self._client.post(
+                    url, json=payload, timeout=httpx.Timeout(remaining, connect=min(remaining, HF_CONNECT_TIMEOUT))
+                )
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    result = response.json()
+                    self.breaker.record(True)
+                    self.counters["ok"] += 1
+                    self._observe(endpoint, "ok", started)
+                    return result
+                cause = f"HTTP {response.status_code}"
+                delay = _retry_after(response)
+            except httpx.HTTPStatusError as e:
+                self.counters["failed"] += 1
+                self._observe(endpoint, "error", started)
+                if e.response.status_code >= 500:
+                    # 500 등 재시도하지 않는 서버 오류: 브레이커 실패 + fallback 경로로
+                    self.breaker.record(False)
+                    raise NeuralUnavailable(f"{endpoint} failed: HTTP {e.response.status_code}") from e
+                # 4xx: 서버는 살아 있으므로 브레이커 실패로 세지 않는다
+                self.breaker.record(True)
+                raise
+            except RETRY_ERRORS as e:
+                cause = repr(e)
+            except httpx.TimeoutException as e:
+                # 응답 대기 중 타임아웃 → 예산 소진, 재시도하지 않음
+                cause = repr(e)
+                attempt = self.retries
+            except asyncio.CancelledError:
+                self.breaker.release()  # 클라이언트가 끊은 경우: 판정 없이 probe 자리만 반납
+                raise
+            except Exception:
+                self.breaker.record(False)
+                self.counters["failed"] += 1
+                self._observe(endpoint, "error", started)
+                raise
+
+            if delay is None:
+                delay = random.uniform(0, HF_RETRY_BACKOFF * (2 ** attempt))  # full jitter
+            else:
+                delay += random.uniform(0, HF_RETRY_BACKOFF)
+            if attempt >= self.retries or time.perf_counter() + delay >= deadline:
+                self.breaker.record(False)
+                self.counters["failed"] += 1
+                self._observe(endpoint, "unavailable", started)
+                raise NeuralUnavailable(f"{endpoint} failed after {attempt + 1} attempt(s): {cause}")
+            attempt += 1
+            self.counters["retries"] += 1
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "connected": self._client is not None,
+            "breaker": self.breaker.stats(),
+            **self.counters,
+            "latency_ms": {key: h.stats() for key, h in sorted(self.histograms.items())},
+        }
+
+
+# 전역 인스턴스 (app.py lifespan에서 start/aclose)
+neural_client = NeuralClient()
+
 
 async def _post(endpoint: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     """
     Hugging Face Spaces에 POST 요청을 보내는 내부 함수.
     endpoint는 '/predict_main' 같은 상대 경로.
     """
-    url = f"{HF_SERVE_URL.rstrip('/')}{endpoint}"
-    async with httpx.AsyncClient(timeout=HF_TIMEOUT) as client:
-        response = await client.post(url, json=payload)
-        response.raise_for_status()
-        return response.json()
+    return await neural_client.post(endpoint, payload)
 
 async def call_main(payload: Dict[str, Any]) -> Dict[str, Any]:
     """
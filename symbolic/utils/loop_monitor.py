@@ -0,0 +1,47 @@
+import asyncio
+import time
+from collections import deque
+
+
+class LoopLagMonitor:
+    """
+    이벤트 루프 지연 측정: `interval`마다 sleep 후 실제로 깨어난 시각과의 차이를 기록.
+    동기 코드(예: 루프 위에서 돈 model.generate)가 루프를 막으면 그 시간만큼 lag로 나타난다.
+    """
+
+    def __init__(self, interval: float = 0.05, window: int = 2048):
+        self.interval = interval
+        self.lags = deque(maxlen=window)
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - t0 - self.interval))
+
+    def reset(self):
+        self.lags.clear()
+
+    def stats(self) -> dict:
+        if not self.lags:
+            return {"samples": 0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+        ordered = sorted(self.lags)
+
+        def pick(q):
+            return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+        return {"samples": len(ordered), "p50_ms": pick(0.5), "p99_ms": pick(0.99), "max_ms": round(ordered[-1] * 1000, 1)}